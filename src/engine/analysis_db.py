@@ -0,0 +1,135 @@
+"""
+Persistent analysis database: engine results are stored on disk (sqlite) and shared across sessions,
+by both PVengine and PVtrace.
+Deeper results replace shallower ones, and the least recently used entries are removed
+when the database grows beyond its size limit.
+"""
+import sqlite3
+import threading
+import time
+
+import chess
+import chess.engine
+
+from cache import position_key
+
+EVICT_INTERVAL = 256  # check the size limit every x stores
+# Writes are committed in batches: at the end of every search (see commit) and at least this often (seconds),
+# so that other processes sharing the database are not locked out for long
+COMMIT_INTERVAL = 1.0
+
+
+def db_key(pos: chess.Board):
+    """position_key as a string."""
+    zobrist, moves = position_key(pos)
+    return f"{zobrist:016x} {' '.join(move.uci() for move in moves)}".strip()
+
+
+class AnalysisDB:
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.stores = 0
+        self.hits = 0
+        self.last_commit = time.time()
+        self.lock = threading.Lock()  # shared by all pool workers
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS analysis (
+                key TEXT NOT NULL,
+                engine TEXT NOT NULL,
+                score_cp INTEGER,
+                score_mate INTEGER,
+                pv TEXT NOT NULL,
+                depth INTEGER NOT NULL,
+                seldepth INTEGER NOT NULL,
+                nodes INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (key, engine))""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS analysis_last_used ON analysis (last_used)")
+            self.conn.commit()
+
+    def probe(self, pos: chess.Board, engine_id: str, depth: int = None, nodes: int = None):
+        """
+        Return the stored InfoDict if it is at least as deep as requested, otherwise None.
+        Only depth and node limits can be compared, so other searches always return None.
+        The returned InfoDict reports 0 nodes, since no new nodes were searched.
+        """
+        if depth is None and nodes is None:
+            return None
+
+        key = db_key(pos)
+        with self.lock:
+            row = self.conn.execute("SELECT score_cp, score_mate, pv, depth, seldepth, nodes FROM analysis "
+                                    "WHERE key = ? AND engine = ?", (key, engine_id)).fetchone()
+            if row is None:
+                return None
+            score_cp, score_mate, pv, row_depth, seldepth, row_nodes = row
+            if (depth is not None and row_depth < depth) or (nodes is not None and row_nodes < nodes):
+                return None
+
+            self.conn.execute("UPDATE analysis SET last_used = ? WHERE key = ? AND engine = ?",
+                              (time.time(), key, engine_id))
+            self.commit_if_due()
+            self.hits += 1
+
+        score = chess.engine.Mate(score_mate) if score_mate is not None else chess.engine.Cp(score_cp)
+        return {
+            "score": chess.engine.PovScore(score, pos.turn),
+            "pv": [chess.Move.from_uci(move) for move in pv.split()],
+            "depth": row_depth,
+            "seldepth": seldepth,
+            "nodes": 0,
+            "nps": 0,
+            "time": 0.0,
+        }
+
+    def store(self, pos: chess.Board, info: dict, engine_id: str, nodes: int = 0):
+        """Store an engine result, unless a deeper result is already stored."""
+        if "score" not in info or "pv" not in info:
+            return
+
+        score = info["score"].relative
+        depth = info.get("depth", 0)
+        row = (db_key(pos), engine_id, score.score(), score.mate(), " ".join(move.uci() for move in info["pv"]),
+               depth, info.get("seldepth", depth), max(nodes, info.get("nodes", 0)), time.time())
+
+        with self.lock:
+            self.conn.execute("""INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key, engine) DO UPDATE SET
+                    score_cp = excluded.score_cp, score_mate = excluded.score_mate, pv = excluded.pv,
+                    depth = excluded.depth, seldepth = excluded.seldepth, nodes = excluded.nodes,
+                    last_used = excluded.last_used
+                WHERE excluded.depth > analysis.depth
+                    OR (excluded.depth = analysis.depth AND excluded.nodes > analysis.nodes)""", row)
+
+            self.stores += 1
+            if self.stores % EVICT_INTERVAL == 0:
+                self.evict()
+            self.commit_if_due()
+
+    def commit_if_due(self):
+        """Commit if the last commit is more than COMMIT_INTERVAL ago. The lock must be held."""
+        if time.time() - self.last_commit >= COMMIT_INTERVAL:
+            self.conn.commit()
+            self.last_commit = time.time()
+
+    def commit(self):
+        """Commit the pending writes, e.g. at the end of a search."""
+        with self.lock:
+            self.conn.commit()
+            self.last_commit = time.time()
+
+    def evict(self):
+        """Remove the least recently used entries above the size limit. The lock must be held."""
+        count = self.conn.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute("DELETE FROM analysis WHERE rowid IN "
+                              "(SELECT rowid FROM analysis ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
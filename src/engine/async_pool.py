@@ -0,0 +1,212 @@
+"""
+Asyncio engine backend.
+All engines of the pool are driven by coroutines on a single event loop, which runs in its own thread.
+An engine that crashes or misses the deadline of a search is replaced, like in the other backends
+(see evaluate.replace_engine).
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+import chess
+import chess.engine
+
+
+class AsyncEnginePool:
+    """A pool of UCI engines started with chess.engine.popen_uci.
+
+    Jobs are kept in a queue on the event loop, and each engine takes the next job
+    as soon as it finishes the previous one, so there is no idle gap between searches."""
+
+    def __init__(self, path: str, size: int, engine_options: dict, observe: callable = None,
+                 info: chess.engine.Info = chess.engine.INFO_ALL, spare_options: dict = None):
+        """
+        engine_options: the options of the engines. The dict is kept, so later changes apply to new engines.
+        spare_options: if given, a warm spare engine with these options replaces an engine that fails
+        """
+        self.path = path
+        self.engine_options = engine_options
+        self.spare_options = spare_options
+        self.observe = observe  # called with (nodes, seconds) after every completed search
+        self.info = info  # the info to parse from the engine output
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.engines = []  # list of chess.engine.UciProtocol
+        self.locks = {}  # key: engine, value: asyncio.Lock held while the engine is busy
+        self.spare = None  # warm standby engine
+        self.replacements = {}  # key: engine that crashed or hung, value: the engine that replaced it
+        self.replace_lock = None  # asyncio.Lock, created on the event loop
+        self.run(self._start(path, size, engine_options))
+
+    def run(self, coro):
+        """Run a coroutine on the event loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def size(self):
+        return len(self.engines)
+
+    async def _start(self, path: str, size: int, engine_options: dict):
+        self.replace_lock = asyncio.Lock()
+        for _ in range(size):
+            _, protocol = await chess.engine.popen_uci(path)
+            self.engines.append(protocol)
+            self.locks[protocol] = asyncio.Lock()
+        await self._configure(engine_options)
+        self.loop.create_task(self._start_spare())  # nothing waits for the spare
+
+    async def _configure(self, engine_options: dict):
+        for protocol in self.engines:
+            await self._configure_engine(protocol, engine_options)
+        if self.spare is not None:
+            await self._configure_engine(self.spare, {name: value for name, value in engine_options.items()
+                                                      if name not in self.spare_options})
+
+    async def _configure_engine(self, protocol: chess.engine.UciProtocol, engine_options: dict):
+        async with self.locks[protocol]:
+            for name, value in engine_options.items():
+                try:
+                    await protocol.configure({name: value})
+                except Exception:
+                    pass  # sometimes there may be unsupported options
+            await protocol.ping()  # wait until the engine has applied the options, e.g. allocated the hash
+
+    def configure(self, engine_options: dict):
+        self.run(self._configure(engine_options))
+
+    async def _start_spare(self):
+        """Start the spare engine, if enabled and not running."""
+        if self.spare_options is None or self.spare is not None:
+            return
+        try:
+            _, protocol = await chess.engine.popen_uci(self.path)
+            self.locks[protocol] = asyncio.Lock()
+            await self._configure_engine(protocol, dict(self.engine_options, **self.spare_options))
+        except Exception:
+            return  # the engines are restarted by the next search if needed
+        if self.spare is None and self.engines:  # otherwise another spare was started or the pool quit
+            self.spare = protocol
+        else:
+            await self._quit_engine(protocol)
+
+    async def _replace(self, protocol: chess.engine.UciProtocol):
+        """Replace an engine that crashed or hung by the spare, or else by a new engine. Returns the new engine."""
+        async with self.replace_lock:
+            if protocol in self.replacements.keys():
+                return self.replacements[protocol]  # another search has already replaced it
+            self.kill(protocol)
+            new, self.spare = self.spare, None
+            if new is None:
+                _, new = await chess.engine.popen_uci(self.path)
+                self.locks[new] = asyncio.Lock()
+            await self._configure_engine(new, self.engine_options)  # allocates the full hash of a promoted spare
+            self.replacements[protocol] = new
+            self.engines = [new if e is protocol else e for e in self.engines]
+        self.loop.create_task(self._start_spare())
+        return new
+
+    @staticmethod
+    def kill(protocol: chess.engine.UciProtocol):
+        """Kill a hung engine. Its search in progress then fails with EngineTerminatedError."""
+        try:
+            protocol.transport.kill()
+        except Exception:
+            pass
+
+    async def _analyse(self, slot: int, pos: chess.Board, limit: chess.engine.Limit,
+                       multipv: int = None, root_moves: list = None, handle=None, deadline: float = None):
+        """
+        Like protocol.analyse() on self.engines[slot], but the search can be interrupted by handle.stop()
+        (see evaluate.EngineHandle).
+        If the engine crashes or the search takes longer than deadline (seconds),
+        the engine is replaced and the search is repeated once.
+        """
+        protocol = self.engines[slot]
+        try:
+            return await self._analyse_once(protocol, pos, limit, multipv, root_moves, handle, deadline)
+        except (chess.engine.EngineTerminatedError, OSError):
+            protocol = await self._replace(protocol)
+            return await self._analyse_once(protocol, pos, limit, multipv, root_moves, handle, deadline)
+
+    async def _analyse_once(self, protocol: chess.engine.UciProtocol, pos: chess.Board, limit: chess.engine.Limit,
+                            multipv: int = None, root_moves: list = None, handle=None, deadline: float = None):
+        """Several searches may share the pool, so each engine only runs one analysis at a time."""
+        async with self.locks[protocol]:
+            start = time.time()
+            result = await protocol.analysis(pos, limit, multipv=multipv, root_moves=root_moves, info=self.info)
+            if handle is not None:
+                handle.add(result, lambda: self.loop.call_soon_threadsafe(result.stop))
+            try:
+                # not asyncio.wait_for: cancelling result.wait() would break the analysis
+                waiter = asyncio.ensure_future(result.wait())
+                done, _ = await asyncio.wait({waiter}, timeout=deadline)
+                if not done:
+                    self.kill(protocol)  # the search then fails with EngineTerminatedError
+                await waiter
+            finally:
+                if handle is not None:
+                    handle.remove(result)
+            infos = [info.copy() for info in result.multipv]
+            if self.observe is not None and (handle is None or not handle.is_stopped()):
+                self.observe(infos[0].get("nodes", 0), time.time() - start)
+        return infos if multipv is not None else infos[0]
+
+    async def _analyse_many(self, jobs: list, handle=None, slots: list = None):
+        results = [None] * len(jobs)
+        # jobs meant for each engine, which are taken by other engines only once they have nothing else to do
+        own = [deque() for _ in self.engines]
+        for index, job in enumerate(jobs):
+            own[slots[index] if slots is not None else index % len(self.engines)].append((index, job))
+
+        async def worker(slot: int):
+            while own[slot] or any(own):
+                index, (pos, limit, deadline) = own[slot].popleft() if own[slot] else max(own, key=len).pop()
+                results[index] = await self._analyse(slot, pos, limit, handle=handle, deadline=deadline)
+
+        await asyncio.gather(*[worker(slot) for slot in range(len(self.engines))])
+        return results
+
+    def analyse_many(self, jobs: list, handle=None, slots: list = None):
+        """
+        jobs: list of (board, limit, deadline) tuples, deadline in seconds or None
+        slots: if given, the engine (index) that each job is meant for
+        Returns the results in the same order as jobs.
+        """
+        return self.run(self._analyse_many(jobs, handle, slots))
+
+    def analyse(self, pos: chess.Board, limit: chess.engine.Limit, multipv: int = None, root_moves: list = None,
+                handle=None, deadline: float = None):
+        """Search a single position with the first engine."""
+        return self.run(self._analyse(0, pos, limit, multipv=multipv, root_moves=root_moves, handle=handle,
+                                      deadline=deadline))
+
+    async def _ping(self):
+        for protocol in self.engines:
+            if not self.locks[protocol].locked():  # a busy engine is alive
+                await protocol.ping()
+
+    def is_alive(self):
+        try:
+            self.run(asyncio.wait_for(self._ping(), 5))
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    async def _quit_engine(protocol: chess.engine.UciProtocol):
+        try:
+            await asyncio.wait_for(protocol.quit(), 5)
+        except Exception:
+            pass
+
+    async def _quit(self):
+        for protocol in self.engines + ([self.spare] if self.spare is not None else []):
+            await self._quit_engine(protocol)
+        self.engines = []
+        self.spare = None
+
+    def quit(self):
+        self.run(self._quit())
+        self.loop.call_soon_threadsafe(self.loop.stop)
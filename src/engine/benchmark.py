@@ -1,7 +1,10 @@
 import search
 import chess
+import chess.engine
 import time, os
 import timeman
+import evaluate
+from ucioption import option, options, setoption
 
 
 def bench(depth: int = 3):
@@ -29,3 +32,34 @@ def bench(depth: int = 3):
 
     # Quit
     os._exit(0)
+
+
+def bench_overhead(calls: int = 1000):
+    """
+    Measure the time per engine call of a 1 node search with every backend.
+    Nearly all of it is overhead: process IPC, protocol handling and info parsing.
+    """
+    # positions along a short game, so that the engine cannot reuse its last search
+    positions = []
+    pos = chess.Board()
+    for move in "e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 e1g1 f8e7".split():
+        pos.push_uci(move)
+        positions.append(pos.copy())
+
+    # the caches would answer most calls
+    evaluate.eval_cache.resize(0)
+    analysis_db, evaluate.analysis_db = evaluate.analysis_db, None
+
+    backend = option("Backend")
+    for choice in options["Backend"].choices:
+        setoption("Backend", choice)
+        evaluate.ensure_engine()
+        start = time.time()
+        for k in range(calls):
+            evaluate.__engine__(positions[k % len(positions)], nodes=1)
+        elapsed = time.time() - start
+        print(f"Backend {choice}: {round(elapsed / calls * 1e6)} us per call")
+
+    setoption("Backend", backend)
+    evaluate.eval_cache.resize(option("Eval Cache"))
+    evaluate.analysis_db = analysis_db
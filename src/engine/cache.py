@@ -0,0 +1,89 @@
+"""
+Evaluation cache: remembers engine results for positions that were already searched.
+"""
+import threading
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+
+ENTRY_SIZE = 1024  # estimated memory used by one entry (key, InfoDict and PV), in bytes
+
+
+def position_key(pos: chess.Board):
+    """Zobrist hash of the position, together with the moves played since the last irreversible move.
+    Those moves decide which repetitions the engine can see, so they are part of the key."""
+    reversible = min(pos.halfmove_clock, len(pos.move_stack))
+    return chess.polyglot.zobrist_hash(pos), tuple(pos.move_stack[len(pos.move_stack) - reversible:])
+
+
+class EvalCache:
+    """An LRU cache of engine results, shared by all engines in the pool.
+    An entry is only used if it was searched with at least as many nodes as requested."""
+
+    def __init__(self, size_mb: int):
+        self.entries = OrderedDict()  # key: position_key, value: (info, nodes, depth)
+        self.lock = threading.Lock()
+        self.max_entries = 0
+        self.hits = self.misses = 0
+        self.resize(size_mb)
+
+    def resize(self, size_mb: int):
+        with self.lock:
+            self.max_entries = size_mb * 1024 * 1024 // ENTRY_SIZE
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def enabled(self):
+        return self.max_entries > 0
+
+    def probe(self, pos: chess.Board, nodes: int):
+        """Return the cached InfoDict if it was searched with at least `nodes` nodes, otherwise None.
+        The returned InfoDict reports 0 nodes, since no new nodes were searched."""
+        if not self.enabled():
+            return None
+
+        key = position_key(pos)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < nodes:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+        info = dict(entry[0])
+        info["nodes"] = 0
+        return info
+
+    def store(self, pos: chess.Board, info: dict, nodes: int):
+        """Store an engine result, unless a result with more nodes is already stored."""
+        if not self.enabled() or "pv" not in info or "score" not in info:
+            return
+
+        key = position_key(pos)
+        nodes = max(nodes, info.get("nodes", 0))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] >= nodes:
+                return
+            self.entries[key] = (info, nodes, info.get("depth", 0))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    def stats_str(self, hits: int = None, misses: int = None):
+        """The statistics of the cache, with the hits and misses of one search if given."""
+        hits = self.hits if hits is None else hits
+        misses = self.misses if misses is None else misses
+        probes = hits + misses
+        rate = 100 * hits / probes if probes else 0
+        return f"hits {hits} misses {misses} hitrate {rate:.1f}% entries {len(self.entries)}"
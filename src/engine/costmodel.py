@@ -0,0 +1,98 @@
+"""
+Cost model of engine calls: time = latency + nodes / nps.
+The latency covers everything that does not depend on the number of nodes, such as process IPC
+and starting the engine's search. Both parameters are learned from observed calls,
+separately for every engine and thread count, and can be saved to a file between runs.
+"""
+import json
+import threading
+
+DECAY = 0.99  # weight of older observations, so that the model follows changes in speed
+MIN_WEIGHT = 3.0  # total weight of observations needed before the model is used
+
+
+class CostFit:
+    """Weighted least squares fit of time against nodes, favouring recent observations."""
+
+    def __init__(self, sums: list = None):
+        # sums of weights, nodes, seconds, nodes^2 and nodes * seconds
+        self.w, self.x, self.y, self.xx, self.xy = sums if sums is not None else [0.0] * 5
+
+    def observe(self, nodes: int, seconds: float):
+        self.w = self.w * DECAY + 1
+        self.x = self.x * DECAY + nodes
+        self.y = self.y * DECAY + seconds
+        self.xx = self.xx * DECAY + nodes * nodes
+        self.xy = self.xy * DECAY + nodes * seconds
+
+    def params(self):
+        """Return (latency in seconds, nps), or None if there are not enough observations."""
+        if self.w < MIN_WEIGHT or self.xx <= 0:
+            return None
+
+        mx, my = self.x / self.w, self.y / self.w
+        var = self.xx / self.w - mx * mx
+        cov = self.xy / self.w - mx * my
+        # with (almost) equal node counts, the latency cannot be told apart from the nps
+        if var > (0.05 * mx) ** 2 and cov > 0:
+            slope = cov / var
+            latency = my - slope * mx
+        else:
+            latency = -1.0
+        if latency < 0:
+            # fit through the origin instead
+            slope = self.xy / self.xx
+            latency = 0.0
+        if slope <= 0:
+            return None
+        return latency, 1 / slope
+
+    def sums(self):
+        return [self.w, self.x, self.y, self.xx, self.xy]
+
+
+class CostModel:
+    """Cost fits of all engine configurations, shared by all searches."""
+
+    def __init__(self):
+        self.fits = {}  # key: engine configuration, value: CostFit
+        self.key = ""  # configuration of the engines that are currently running
+        self.lock = threading.Lock()
+
+    def select(self, key: str):
+        """Use the fit of this engine configuration from now on."""
+        with self.lock:
+            self.key = key
+            if key not in self.fits.keys():
+                self.fits[key] = CostFit()
+
+    def observe(self, nodes: int, seconds: float):
+        """Record an engine call that searched `nodes` nodes in `seconds` seconds of wall time."""
+        if nodes <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            if self.key not in self.fits.keys():
+                self.fits[self.key] = CostFit()
+            self.fits[self.key].observe(nodes, seconds)
+
+    def params(self):
+        """(latency in seconds, nps of a single engine) of the current configuration, or None if unknown."""
+        with self.lock:
+            fit = self.fits.get(self.key)
+            return fit.params() if fit is not None else None
+
+    def load(self, path: str):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # no saved model yet
+        with self.lock:
+            for key, sums in data.items():
+                self.fits[key] = CostFit(sums)
+
+    def save(self, path: str):
+        with self.lock:
+            data = {key: fit.sums() for key, fit in self.fits.items() if fit.w > 0}
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1)
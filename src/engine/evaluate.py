@@ -5,12 +5,101 @@ from ucioption import *
 from timeman import Time
 
 import os
+import queue
+import shutil
+import threading
+import time
+from collections import deque
+
+from analysis_db import AnalysisDB
+from async_pool import AsyncEnginePool
+from cache import EvalCache
+from costmodel import CostModel
+from pipe_engine import PipeEngine
+from watchdog import Watchdog
 
 engine: chess.engine.SimpleEngine = None
+engines: list = []  # engine pool, engines[0] is always `engine`
+pool_jobs: "PoolJobs" = None  # jobs for the pool workers, one worker thread per engine
+async_pool: AsyncEnginePool = None  # replaces all of the above when the "async" backend is used
+eval_cache = EvalCache(option("Eval Cache"))
+analysis_db: AnalysisDB = None  # persistent analysis database, if the "Analysis DB" option is set
+cost_model = CostModel()  # time taken by engine calls, used by time management
 engine_options = {
     "Threads": option("Threads"),
     "Hash": option("Hash"),
 }
+engine_locks = {}  # key: engine, value: lock held while the engine is searching
+spare: chess.engine.SimpleEngine = None  # warm standby engine, replaces an engine that crashes or hangs
+spare_generation = 0  # incremented when the spare is dropped, so that a spare that was starting is not kept
+replacements = {}  # key: engine that crashed or hung, value: the engine that replaced it
+spare_lock = threading.Lock()
+watchdog = Watchdog()
+SPARE_HASH = 1  # MB, the spare only allocates the full Hash when it replaces an engine
+HANG_FACTOR = 5  # an engine call is hung if it takes this many times longer than expected
+HANG_MARGIN = 2.0  # seconds, on top of the expected time of an engine call
+MIN_NPS = 100000  # used for the deadline of engine calls before the cost model knows the engine
+setup_jobs = queue.Queue()  # engine start-up and option changes, done in the background (see in_background)
+setup_thread: threading.Thread = None
+setup_lock = threading.Lock()
+# Only the info that we use is parsed from the engine output: depth, seldepth, nodes, nps, time, score and pv
+ANALYSIS_INFO = chess.engine.INFO_BASIC | chess.engine.INFO_SCORE | chess.engine.INFO_PV
+init_lock = threading.Lock()
+
+
+class EngineHandle:
+    """
+    The shared engine pool, as used by one search.
+    Stopping a handle interrupts the engine searches started through it,
+    without affecting other searches that use the pool at the same time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}  # key: analysis in progress, value: function that stops it
+        self.stopped = threading.Event()
+        self.affinity = {}  # key: line (e.g. root move), value: the pool slot that searched it last (see assign_slots)
+        # eval cache and analysis database statistics of this search (see probe_cache)
+        self.cache_hits = self.cache_misses = self.db_hits = 0
+
+    def add(self, analysis, stop):
+        with self.lock:
+            self.running[analysis] = stop
+        if self.stopped.is_set():
+            stop()
+
+    def remove(self, analysis):
+        with self.lock:
+            self.running.pop(analysis, None)
+
+    def stop(self):
+        """Interrupt all engine searches in progress, which then return the latest info sent by the engine.
+        Until allow() is called, new searches are also stopped as soon as they start."""
+        self.stopped.set()
+        with self.lock:
+            running = list(self.running.values())
+        for stop in running:
+            try:
+                stop()
+            except Exception:
+                pass  # the search has just finished
+
+    def allow(self):
+        self.stopped.clear()
+
+    def reset_stats(self):
+        self.cache_hits = self.cache_misses = self.db_hits = 0
+
+    def is_stopped(self):
+        return self.stopped.is_set()
+
+    def analyse(self, **kwargs):
+        """__engine__(), interruptible by stop()."""
+        return __engine__(**kwargs, handle=self)
+
+    def analyse_many(self, jobs: list, keys: list = None):
+        """__engine_pool__(), interruptible by stop()."""
+        return __engine_pool__(jobs, handle=self, keys=keys)
 
 
 def init_engine():
@@ -21,12 +110,12 @@ def init_engine():
     ENGINE_PATH = option("ENGINE_PATH")
     ENGINE_MISSING = False
     try:
-        engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
+        engine = open_engine(ENGINE_PATH)
     except FileNotFoundError:
         ENGINE_MISSING = True
 
     try:
-        engine.analyse(chess.Board(), chess.engine.Limit(nodes=1))
+        analyse(engine, chess.Board(), chess.engine.Limit(nodes=1))
     except Exception:
         ENGINE_MISSING = True
 
@@ -40,13 +129,187 @@ def init_engine():
             print("Failed to download engine. Error:", e)
             os._exit(0)
 
-        options["ENGINE_PATH"] = ENGINE_PATH
-        engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
+        options["ENGINE_PATH"].value = ENGINE_PATH
+        engine = open_engine(ENGINE_PATH)
         print("Engine downloaded successfully.")
 
+    init_engine_pool()
     setoptions_engine()
 
 
+def init_engine_pool():
+    """Start the worker engines, so that the pool contains option("Workers") engines in total.
+    Should only be called when no search is running."""
+    global engine, engines, pool_jobs, async_pool
+
+    if pool_jobs is not None:
+        pool_jobs.close()  # stop the workers
+        pool_jobs = None
+    engine_locks.clear()
+    for e in engines[1:]:
+        try:
+            e.quit()
+        except Exception:
+            pass
+    drop_spare()
+    if async_pool is not None:
+        async_pool.quit()
+        async_pool = None
+
+    if option("Backend") == "async":
+        # the main engine is only needed to check ENGINE_PATH, all searches go through the async pool
+        if engine is not None:
+            engine.quit()
+            engine = None
+        engines = []
+        async_pool = AsyncEnginePool(option("ENGINE_PATH"), option("Workers"), engine_options, cost_model.observe,
+                                     info=ANALYSIS_INFO,
+                                     spare_options={"Hash": SPARE_HASH} if option("Spare engine") else None)
+        return
+
+    if engine is not None and isinstance(engine, PipeEngine) != (option("Backend") == "pipe"):
+        engine.quit()  # the backend was changed
+        engine = None
+    if engine is None:
+        engine = open_engine(option("ENGINE_PATH"))
+    engines = [engine]
+    for _ in range(option("Workers") - 1):
+        engines.append(open_engine(option("ENGINE_PATH")))
+
+    if len(engines) > 1:
+        pool_jobs = PoolJobs(len(engines))
+        for slot in range(len(engines)):
+            threading.Thread(target=pool_worker, args=(slot, pool_jobs), daemon=True).start()
+    spawn_spare()
+
+
+def open_engine(path: str):
+    """Start an engine process for the "simple" or "pipe" backend."""
+    if option("Backend") == "pipe":
+        return PipeEngine(path)
+    return chess.engine.SimpleEngine.popen_uci(path)
+
+
+def pool_size():
+    """Number of engines that can search at the same time."""
+    if async_pool is not None:
+        return async_pool.size()
+    return max(len(engines), 1)
+
+
+def batch_size():
+    """Number of root moves that the search should submit to the pool at once.
+    The async backend queues a second job for every engine, so that it never waits for the search."""
+    if async_pool is not None:
+        return 2 * pool_size()
+    return pool_size()
+
+
+def engine_id():
+    """Name of the engine, used to tell apart results of different engines in the analysis database."""
+    if async_pool is not None:
+        return async_pool.engines[0].id.get("name", "")
+    return engine.id.get("name", "")
+
+
+def load_cost_model():
+    if option("Cost model"):
+        cost_model.load(option("Cost model"))
+
+
+def save_cost_model():
+    if option("Cost model"):
+        try:
+            cost_model.save(option("Cost model"))
+        except OSError:
+            pass  # not worth failing a search for
+
+
+def save_analysis_db():
+    if analysis_db is not None:
+        analysis_db.commit()
+
+
+def open_analysis_db():
+    global analysis_db
+    if analysis_db is not None:
+        analysis_db.close()
+        analysis_db = None
+    if option("Analysis DB"):
+        analysis_db = AnalysisDB(option("Analysis DB"), option("Analysis DB size"))
+
+
+def is_alive():
+    try:
+        if async_pool is not None:
+            return async_pool.is_alive()
+        lock = engine_lock(engine)
+        if not lock.acquire(blocking=False):
+            return True  # another search is using the engine
+        try:
+            engine.ping()
+        finally:
+            lock.release()
+        return True
+    except Exception:
+        return False
+
+
+def start_engine():
+    """Start the engines if they are not running. Several searches may call this at the same time."""
+    with init_lock:
+        if not is_alive():
+            init_engine()
+
+
+def ensure_engine():
+    """Make sure that the engines are running and that all option changes have been applied."""
+    wait_ready()
+    start_engine()
+
+
+def setup_worker():
+    while True:
+        job = setup_jobs.get()
+        try:
+            job()
+        except Exception:
+            pass  # the next search restarts the engines if needed
+        finally:
+            setup_jobs.task_done()
+
+
+def in_background(job: callable):
+    """
+    Run job in the background, after the jobs submitted before it.
+    Starting and configuring the engines is slow (process start, network loading, hash allocation),
+    so we do it as soon as possible rather than when a search starts.
+    """
+    global setup_thread
+    with setup_lock:
+        if setup_thread is None:
+            setup_thread = threading.Thread(target=setup_worker, daemon=True)
+            setup_thread.start()
+    setup_jobs.put(job)
+
+
+def wait_ready():
+    """Wait until all background jobs are done. Must not be called from a background job."""
+    setup_jobs.join()
+
+
+def warm_up():
+    """Start the engines in the background, if the engine can be found.
+    Otherwise they are started by the first isready or search, which may download the engine."""
+    if shutil.which(option("ENGINE_PATH")) is not None:
+        in_background(start_engine)
+
+
+def engine_lock(e: chess.engine.SimpleEngine):
+    """An engine can only run one command at a time, even if several searches share it."""
+    return engine_locks.setdefault(e, threading.Lock())
+
+
 def setoptions_engine():
     global engine, engine_options
     # UCI options
@@ -55,24 +318,259 @@ def setoptions_engine():
     engine_options["Threads"] = option("Threads")
     engine_options["Hash"] = option("Hash")
 
-    for name, value in engine_options.items():
+    for e in engines:
+        configure_engine(e)
+    if spare is not None:
+        configure_engine(spare, spare_options())
+    if async_pool is not None:
+        async_pool.configure(engine_options)
+    if engine is not None or async_pool is not None:
+        cost_model.select(f"{engine_id()} Threads {engine_options['Threads']}")
+
+
+def configure_engine(e: chess.engine.SimpleEngine, options: dict = None):
+    with engine_lock(e):
+        for name, value in (options or engine_options).items():
+            try:
+                e.configure({name: value})
+            except:
+                pass  # sometimes there may be unsupported options
+        e.ping()  # wait until the engine has applied the options, e.g. allocated the hash
+
+
+def clear_hash():
+    """Clear the hash tables of all engines, e.g. for a new game."""
+    for e in engines + ([spare] if spare is not None else []):
+        with engine_lock(e):
+            try:
+                e.configure({"Clear Hash": None})
+            except Exception:
+                pass  # not supported by the engine
+    if async_pool is not None:
+        async_pool.configure({"Clear Hash": None})
+
+
+def spawn_spare():
+    """
+    Start the spare engine in a thread of its own.
+    Not with in_background: the next search would wait for it in ensure_engine, on the game clock.
+    """
+    threading.Thread(target=start_spare, args=(spare_generation,), daemon=True).start()
+
+
+def start_spare(generation: int):
+    """Start the spare engine, if enabled and not running. The async backend keeps its own spare."""
+    global spare
+    if not option("Spare engine") or async_pool is not None or spare is not None:
+        return
+    try:
+        e = open_engine(option("ENGINE_PATH"))
+        configure_engine(e, spare_options())
+    except Exception:
+        return  # the engines are restarted by the next search if needed
+    with spare_lock:
+        if spare is None and generation == spare_generation:
+            spare, e = e, None
+    if e is not None:
+        e.quit()  # the pool was rebuilt or another spare was started meanwhile
+
+
+def spare_options():
+    """The options of the spare engine: those of the pool, with a minimal hash until it is promoted."""
+    return dict(engine_options, Hash=SPARE_HASH)
+
+
+def drop_spare():
+    global spare, spare_generation
+    with spare_lock:
+        e, spare = spare, None
+        spare_generation += 1
+    if e is not None:
         try:
-            engine.configure({name: value})
-        except:
-            pass  # sometimes there may be unsupported options
+            e.quit()
+        except Exception:
+            pass
+
+
+def replace_engine(e: chess.engine.SimpleEngine):
+    """
+    Replace an engine that crashed or hung by the spare, and start a new spare in the background.
+    Without a spare, a new engine is started right away. Returns the engine that replaces e.
+    """
+    global engine, spare
+    with spare_lock:
+        if e in replacements.keys():
+            return replacements[e]  # another search has already replaced it
+        new, spare = spare, None
+        if new is None:
+            new = open_engine(option("ENGINE_PATH"))
+        configure_engine(new)  # allocates the full hash of a promoted spare
+        replacements[e] = new
+        for slot in range(len(engines)):
+            if engines[slot] is e:
+                engines[slot] = new
+        if engine is e:
+            engine = new
+    try:
+        e.close()
+    except Exception:
+        pass
+    spawn_spare()
+    return new
+
+
+def kill_engine(e: chess.engine.SimpleEngine):
+    """Kill a hung engine. Its search in progress then fails with EngineTerminatedError."""
+    try:
+        e.close()
+    except Exception:
+        pass
+
+
+def call_deadline(limit: chess.engine.Limit, turn: chess.Color, timeMan: Time = None):
+    """The time (seconds) after which an engine call with this limit is considered hung, or None for no limit."""
+    if limit.time is not None:
+        expected = limit.time
+    elif limit.white_clock is not None or limit.black_clock is not None:
+        if timeMan is not None and timeMan.maxTime:
+            # the search stops the engine at maxTime (see Searcher.start_max_timer), after which
+            # a healthy engine answers at once: waiting any longer only loses time on the clock
+            return timeMan.maxTime / 1000 + HANG_MARGIN
+        expected = (limit.white_clock if turn == chess.WHITE else limit.black_clock) or 0
+    elif limit.nodes is not None:
+        params = cost_model.params()
+        latency, nps = params if params is not None else (0.0, MIN_NPS)
+        expected = latency + limit.nodes / nps
+    else:
+        return None  # searches limited by depth only may take very long
+    return expected * HANG_FACTOR + HANG_MARGIN
 
 
 def __engine__(pos: chess.Board, depth: int = None, nodes: int = None,
-               movetime: float = None, timeMan: Time = None):
+               movetime: float = None, timeMan: Time = None, engine_: chess.engine.SimpleEngine = None,
+               multipv: int = None, root_moves: list = None, handle: EngineHandle = None):
     """
     fen: FEN string
     depth: depth to search to
     nodes: number of nodes to search
     time: time to search for
+    engine_: the engine to use, defaults to the main engine.
+             The eval cache is only used if no engine is given.
+    multipv: if given, return a list of InfoDicts, one for each of the best `multipv` moves
+    root_moves: if given, only these moves are searched at the root
+    handle: if given, the search can be interrupted by handle.stop()
     """
     global engine
 
-    # Create a new limit
+    use_cache = engine_ is None and multipv is None and root_moves is None and \
+        is_cacheable(pos, depth, nodes, movetime, timeMan)
+    if use_cache:
+        result = probe_cache(pos, nodes, handle)
+        if result is not None:
+            return result
+
+    limit = make_limit(depth, nodes, movetime, timeMan)
+    pos = compact(pos)
+
+    # Evaluate with engine
+    if engine_ is None and async_pool is not None:
+        result = async_pool.analyse(pos, limit, multipv=multipv, root_moves=root_moves, handle=handle,
+                                    deadline=call_deadline(limit, pos.turn, timeMan))
+    else:
+        if engine_ is None:
+            engine_ = engine
+        result = analyse(engine_, pos, limit, multipv=multipv, root_moves=root_moves, handle=handle,
+                         timeMan=timeMan)
+
+    if use_cache:
+        store_cache(pos, result, nodes_searched(nodes, handle))
+    return result
+
+
+def analyse(e: chess.engine.SimpleEngine, pos: chess.Board, limit: chess.engine.Limit, multipv: int = None,
+            root_moves: list = None, handle: EngineHandle = None, timeMan: Time = None):
+    """
+    Like e.analyse(), but the search can be interrupted through handle.
+    An interrupted search returns the latest info sent by the engine.
+    If the engine crashes or hangs, it is replaced (see replace_engine) and the search is repeated once.
+    timeMan: the time management of a clock limited search, used to detect a hung engine in time
+    """
+    try:
+        return analyse_once(e, pos, limit, multipv, root_moves, handle, timeMan)
+    except (chess.engine.EngineTerminatedError, OSError):
+        return analyse_once(replace_engine(e), pos, limit, multipv, root_moves, handle, timeMan)
+
+
+def analyse_once(e: chess.engine.SimpleEngine, pos: chess.Board, limit: chess.engine.Limit, multipv: int = None,
+                 root_moves: list = None, handle: EngineHandle = None, timeMan: Time = None):
+    with engine_lock(e):
+        start = time.time()
+        deadline = call_deadline(limit, pos.turn, timeMan)
+        if deadline is not None:
+            watchdog.watch(e, deadline, lambda: kill_engine(e))
+        try:
+            infos = engine_analyse(e, pos, limit, multipv, root_moves, handle)
+        finally:
+            watchdog.unwatch(e)
+        if handle is None or not handle.is_stopped():
+            cost_model.observe(infos[0].get("nodes", 0), time.time() - start)
+    return infos if multipv is not None else infos[0]
+
+
+def engine_analyse(e: chess.engine.SimpleEngine, pos: chess.Board, limit: chess.engine.Limit, multipv: int = None,
+                   root_moves: list = None, handle: EngineHandle = None):
+    """Run the search on the engine and return the list of infos, one for every PV."""
+    if isinstance(e, PipeEngine):
+        return e.analyse(pos, limit, multipv=multipv or 1, root_moves=root_moves, handle=handle)
+    with e.analysis(pos, limit, multipv=multipv, root_moves=root_moves, info=ANALYSIS_INFO) as result:
+        if handle is not None:
+            handle.add(result, result.stop)
+        try:
+            result.wait()
+        finally:
+            if handle is not None:
+                handle.remove(result)
+        return result.multipv
+
+
+def nodes_searched(nodes: int, handle: EngineHandle = None):
+    """The nodes that a result is worth in the caches: an interrupted search only counts the nodes
+    reported by the engine."""
+    return 0 if handle is not None and handle.is_stopped() else nodes
+
+
+def is_cacheable(pos: chess.Board, depth: int = None, nodes: int = None, movetime: float = None,
+                 timeMan: Time = None):
+    """Only searches limited purely by nodes are cached, since their results can be compared."""
+    return nodes is not None and depth is None and movetime is None and timeMan is None
+
+
+def probe_cache(pos: chess.Board, nodes: int, handle: EngineHandle = None):
+    """Look up a node limited search in the eval cache, then in the analysis database.
+    The hits are counted in the handle, so that every search reports its own statistics."""
+    result = eval_cache.probe(pos, nodes)
+    if handle is not None and eval_cache.enabled():
+        if result is not None:
+            handle.cache_hits += 1
+        else:
+            handle.cache_misses += 1
+    if result is None and analysis_db is not None:
+        result = analysis_db.probe(pos, engine_id(), nodes=nodes)
+        if result is not None:
+            eval_cache.store(pos, result, nodes)
+            if handle is not None:
+                handle.db_hits += 1
+    return result
+
+
+def store_cache(pos: chess.Board, info: chess.engine.InfoDict, nodes: int):
+    eval_cache.store(pos, info, nodes)
+    if analysis_db is not None:
+        analysis_db.store(pos, info, engine_id(), nodes)
+
+
+def make_limit(depth: int = None, nodes: int = None, movetime: float = None, timeMan: Time = None):
+    """Create a chess.engine.Limit from the arguments of __engine__."""
     if timeMan and movetime:
         timeMan = None  # movetime takes precedence
 
@@ -82,13 +580,155 @@ def __engine__(pos: chess.Board, depth: int = None, nodes: int = None,
     limit = chess.engine.Limit(depth=depth, nodes=nodes)
 
     if useTimeMan and not useMoveTime:
-        wtime, btime, winc, binc = timeMan.to_Limit()
-        limit = chess.engine.Limit(white_clock=wtime, black_clock=btime, white_inc=winc, black_inc=binc)
+        wtime, btime, winc, binc, movestogo = timeMan.to_Limit()
+        limit = chess.engine.Limit(white_clock=wtime, black_clock=btime, white_inc=winc, black_inc=binc,
+                                   remaining_moves=movestogo)
     elif movetime:
         limit = chess.engine.Limit(time=movetime)
     elif useMoveTime:
         limit = chess.engine.Limit(time=timeMan.maxTime / 1000)
 
-    # Evaluate with engine
-    result = engine.analyse(pos, limit)
-    return result
+    return limit
+
+
+def compact(pos: chess.Board):
+    """
+    The position with only the moves since the last irreversible move, which is all that the engine needs
+    for repetition detection. python-chess sends the whole move stack to the engine, which replays it.
+    """
+    if len(pos.move_stack) <= pos.halfmove_clock:
+        return pos
+    return pos.copy(stack=pos.halfmove_clock)
+
+
+def to_analyse_args(pos: chess.Board, **kwargs):
+    """Convert keyword arguments of __engine__ to a (board, limit, deadline) tuple (see call_deadline)."""
+    limit = make_limit(**kwargs)
+    return compact(pos), limit, call_deadline(limit, pos.turn, kwargs.get("timeMan"))
+
+
+class PoolJobs:
+    """
+    Jobs for the pool workers. A job may be meant for one worker, whose engine has searched the job's line before.
+    A worker takes its own jobs first, then jobs meant for any worker, and only then jobs of other workers,
+    so that no worker is idle while there is work left.
+    """
+
+    def __init__(self, size: int):
+        self.cond = threading.Condition()
+        self.own = [deque() for _ in range(size)]  # jobs meant for each worker
+        self.shared = deque()  # jobs for any worker
+        self.closed = False
+
+    def put(self, job, slot: int = None):
+        with self.cond:
+            (self.shared if slot is None else self.own[slot]).append(job)
+            self.cond.notify_all()
+
+    def get(self, slot: int):
+        """Wait for the next job of worker `slot`. Returns None once closed."""
+        with self.cond:
+            while True:
+                if self.closed:
+                    return None
+                if self.own[slot]:
+                    return self.own[slot].popleft()
+                if self.shared:
+                    return self.shared.popleft()
+                busiest = max(self.own, key=len)
+                if busiest:
+                    return busiest.pop()  # the last job, the other worker starts with its first jobs
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def pool_worker(slot: int, jobs: PoolJobs):
+    """Take jobs and evaluate them with engines[slot], until the jobs are closed.
+    The engine in the slot changes if it is replaced by the spare."""
+    while True:
+        job = jobs.get(slot)
+        if job is None:
+            return
+        kwargs, results, index, done, handle = job
+        try:
+            results[index] = __engine__(**kwargs, engine_=engines[slot], handle=handle)
+        except Exception as ex:
+            results[index] = ex
+        done.release()
+
+
+def assign_slots(keys: list, weights: list, affinity: dict, size: int):
+    """
+    Choose the pool slot (engine) for every job of a batch.
+    A job goes to the engine that searched the same line before, whose hash table still holds
+    the line's previous search, unless that engine already has more than its share of the batch.
+    Other jobs go to the least loaded engine. The load of a job is its weight, e.g. its nodes.
+    affinity (key: line, value: slot) is updated with the choices.
+    """
+    share = sum(weights) / size + max(weights)
+    load = [0] * size
+    slots = [None] * len(keys)
+    for k, key in enumerate(keys):
+        slot = affinity.get(key)
+        if slot is not None and slot < size and load[slot] + weights[k] <= share:
+            slots[k] = slot
+            load[slot] += weights[k]
+    # the heaviest jobs first, for a better balance
+    for k in sorted(range(len(keys)), key=lambda k: weights[k], reverse=True):
+        if slots[k] is None:
+            slots[k] = min(range(size), key=lambda slot: load[slot])
+            load[slots[k]] += weights[k]
+            affinity[keys[k]] = slots[k]
+    return slots
+
+
+def __engine_pool__(jobs: list, handle: EngineHandle = None, keys: list = None):
+    """
+    Evaluate several positions at once using the engine pool.
+    jobs: list of keyword arguments to __engine__
+    handle: if given, the searches can be interrupted by handle.stop()
+    keys: if given, the line that every job belongs to. The jobs of a line are searched by the same engine
+          whenever the load allows it, so that they can use its hash table.
+    Returns the results in the same order as jobs.
+    """
+    results = [None] * len(jobs)
+    for index, job in enumerate(jobs):
+        if is_cacheable(**job):
+            results[index] = probe_cache(job["pos"], job["nodes"], handle)
+
+    todo = [index for index in range(len(jobs)) if results[index] is None]
+    slots = None
+    if keys is not None and pool_size() > 1 and todo:
+        affinity = handle.affinity if handle is not None else {}
+        slots = assign_slots([keys[index] for index in todo], [jobs[index].get("nodes") or 1 for index in todo],
+                             affinity, pool_size())
+
+    if async_pool is not None:
+        infos = async_pool.analyse_many([to_analyse_args(**jobs[index]) for index in todo], handle=handle,
+                                        slots=slots)
+    elif pool_jobs is None or len(todo) <= 1:
+        # a single job still goes to the engine whose hash holds its line
+        infos = [__engine__(**jobs[index], engine_=engines[slots[k]] if slots is not None else engine, handle=handle)
+                 for k, index in enumerate(todo)]
+    else:
+        infos = [None] * len(todo)
+        done = threading.Semaphore(0)
+        for k, index in enumerate(todo):
+            pool_jobs.put((jobs[index], infos, k, done, handle), slots[k] if slots is not None else None)
+        for _ in todo:
+            done.acquire()
+
+        for info in infos:
+            if isinstance(info, Exception):
+                raise info
+
+    for index, info in zip(todo, infos):
+        results[index] = info
+        if is_cacheable(**jobs[index]):
+            store_cache(jobs[index]["pos"], info, nodes_searched(jobs[index]["nodes"], handle))
+    return results
+
@@ -0,0 +1,165 @@
+"""
+Lightweight UCI driver for the "pipe" backend.
+Our searches are mostly many small node limited searches, so the driver talks to the engine directly
+over its pipes in the calling thread: no event loop, no futures, and only the last info line
+of every PV is parsed, once the engine has sent bestmove.
+"""
+import subprocess
+import threading
+
+import chess
+import chess.engine
+
+
+class PipeEngine:
+    """A UCI engine process, with the subset of the chess.engine.SimpleEngine interface that we use.
+    Only one search can run at a time (see evaluate.engine_lock)."""
+
+    def __init__(self, path: str):
+        self.process = subprocess.Popen([path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        self.id = {}
+        self.option_names = set()  # lower case, as UCI option names are case insensitive
+        self.multipv = 1
+        self.write_lock = threading.RLock()  # stop() is called from other threads
+        self.search_id = 0  # incremented for every search, so that a late stop() cannot stop the next one
+        self.searching = False
+
+        self.send("uci")
+        for line in self.read_until("uciok"):
+            if line.startswith("id name "):
+                self.id["name"] = line[len("id name "):]
+            elif line.startswith("id author "):
+                self.id["author"] = line[len("id author "):]
+            elif line.startswith("option name "):
+                self.option_names.add(line[len("option name "):].split(" type ")[0].lower())
+
+    def send(self, command: str):
+        with self.write_lock:
+            try:
+                self.process.stdin.write(command + "\n")
+                self.process.stdin.flush()
+            except (OSError, ValueError):
+                raise chess.engine.EngineTerminatedError("engine process died")
+
+    def read_until(self, token: str):
+        """Yield the lines sent by the engine, up to and including the first line starting with token."""
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise chess.engine.EngineTerminatedError("engine process died")
+            line = line.strip()
+            yield line
+            if line.startswith(token):
+                return
+
+    def configure(self, options: dict):
+        for name, value in options.items():
+            if name.lower() not in self.option_names:
+                raise chess.engine.EngineError(f"engine does not support option {name}")
+            self.send(f"setoption name {name}" + (f" value {value}" if value is not None else ""))  # None: button
+
+    def ping(self):
+        self.send("isready")
+        for _ in self.read_until("readyok"):
+            pass
+
+    def analyse(self, pos: chess.Board, limit: chess.engine.Limit, multipv: int = None, root_moves: list = None,
+                handle=None):
+        """Like SimpleEngine.analyse(), but the search can be interrupted by handle.stop()
+        (see evaluate.EngineHandle)."""
+        if (multipv or 1) != self.multipv:
+            self.multipv = multipv or 1
+            self.send(f"setoption name MultiPV value {self.multipv}")
+
+        moves = " ".join(move.uci() for move in pos.move_stack)
+        self.send(f"position fen {pos.root().fen()}{f' moves {moves}' if moves else ''}")
+        with self.write_lock:
+            self.search_id += 1
+            search_id = self.search_id
+            self.searching = True
+        self.send(go_command(limit, root_moves))
+        if handle is not None:
+            handle.add(self, lambda: self.stop(search_id))
+
+        lines = {}  # key: multipv, value: the last info line with a PV, or with a score if there is no PV
+        try:
+            for line in self.read_until("bestmove"):
+                if line.startswith("info ") and (" pv " in line or " score " in line) \
+                        and not line.startswith("info string"):
+                    index = line.split(" multipv ")[1].split(" ")[0] if " multipv " in line else "1"
+                    if " pv " in line or index not in lines:  # e.g. "info depth 0 score mate 0" at game over
+                        lines[index] = line
+        finally:
+            with self.write_lock:
+                self.searching = False
+            if handle is not None:
+                handle.remove(self)
+
+        infos = [parse_info(lines[index], pos.turn) for index in sorted(lines.keys(), key=int)] or [{}]
+        return infos if multipv is not None else infos[0]
+
+    def stop(self, search_id: int):
+        with self.write_lock:
+            if self.searching and search_id == self.search_id:  # otherwise the search has already finished
+                self.send("stop")
+
+    def close(self):
+        """Kill the engine process. A search in progress fails with EngineTerminatedError."""
+        self.process.kill()
+
+    def quit(self):
+        try:
+            self.send("quit")
+            self.process.wait(5)
+        except Exception:
+            self.process.kill()
+
+
+def go_command(limit: chess.engine.Limit, root_moves: list = None):
+    """The UCI go command for limit."""
+    command = "go"
+    if limit.white_clock is not None:
+        command += f" wtime {int(limit.white_clock * 1000)}"
+    if limit.black_clock is not None:
+        command += f" btime {int(limit.black_clock * 1000)}"
+    if limit.white_inc is not None:
+        command += f" winc {int(limit.white_inc * 1000)}"
+    if limit.black_inc is not None:
+        command += f" binc {int(limit.black_inc * 1000)}"
+    if limit.remaining_moves is not None:
+        command += f" movestogo {limit.remaining_moves}"
+    if limit.depth is not None:
+        command += f" depth {limit.depth}"
+    if limit.nodes is not None:
+        command += f" nodes {limit.nodes}"
+    if limit.mate is not None:
+        command += f" mate {limit.mate}"
+    if limit.time is not None:
+        command += f" movetime {int(limit.time * 1000)}"
+    if root_moves:
+        command += f" searchmoves {' '.join(move.uci() for move in root_moves)}"
+    return command
+
+
+def parse_info(line: str, turn: chess.Color):
+    """Parse the fields of an info line that we use into an InfoDict."""
+    info = {}
+    tokens = line.split(" ")
+    i = 1
+    while i < len(tokens) - 1:
+        token = tokens[i]
+        if token in ("depth", "seldepth", "nodes", "nps", "multipv"):
+            info[token] = int(tokens[i + 1])
+        elif token == "time":
+            info["time"] = int(tokens[i + 1]) / 1000
+        elif token == "score" and i + 2 < len(tokens):
+            kind, value = tokens[i + 1], int(tokens[i + 2])
+            score = chess.engine.Cp(value) if kind == "cp" else chess.engine.Mate(value)
+            info["score"] = chess.engine.PovScore(score, turn)
+            i += 1
+        elif token == "pv":
+            info["pv"] = [chess.Move.from_uci(move) for move in tokens[i + 1:]]
+            break
+        i += 1
+    return info
@@ -0,0 +1,79 @@
+"""
+Bandit-style scheduler for root moves.
+Root moves are treated as arms in a best-arm identification problem (LUCB style):
+in each iteration we only extend the current best move and the moves that could still overtake it,
+instead of sweeping all root moves.
+"""
+import math
+from collections import deque
+
+import chess
+
+from search_h import GET_MAX_HORIZON, clamp
+
+SIGMA_PRIOR = 60  # assumed eval uncertainty (cp) of a move with no history
+SIGMA_MIN = 5  # evals are never treated as exact
+SWING_HISTORY = 8  # number of recent eval changes used to estimate the uncertainty
+
+
+class BanditScheduler:
+    pulls: dict = None  # key: root move, value: number of times the move was extended
+    values: dict = None  # key: root move, value: latest eval (cp, root side to move's POV)
+    swings: dict = None  # key: root move, value: recent absolute eval changes
+    total = 0
+
+    def __init__(self):
+        self.pulls = {}
+        self.values = {}
+        self.swings = {}
+        self.total = 0
+
+    def update(self, move: chess.Move, value: int):
+        """Record the eval of a root move after it was extended."""
+        if move in self.values.keys():
+            if move not in self.swings.keys():
+                self.swings[move] = deque(maxlen=SWING_HISTORY)
+            self.swings[move].append(abs(value - self.values[move]))
+        self.values[move] = value
+        self.pulls[move] = self.pulls.get(move, 0) + 1
+        self.total += 1
+
+    def radius(self, move: chess.Move, pvLen: int):
+        """Confidence radius of a move's eval, in cp.
+        It grows with the eval swings seen so far, and shrinks with more pulls and with a longer PV,
+        since the end of a long PV is closer to a position that the engine evaluates reliably."""
+        swings = self.swings.get(move)
+        sigma = max(sum(swings) / len(swings), SIGMA_MIN) if swings else SIGMA_PRIOR
+        pulls = self.pulls.get(move, 0)
+        explore = math.sqrt(2 * math.log(self.total + 1) / max(pulls, 1))
+        depthFactor = 1.0 - 0.5 * min(pvLen / GET_MAX_HORIZON(), 1.0)
+        return sigma * explore * depthFactor
+
+    def select(self, candidates: list, rootMovesPv: dict, k: int):
+        """
+        Choose the root moves to extend in this iteration, in the order of candidates.
+        Moves that were never searched are always chosen. Otherwise we choose the best move,
+        and up to k - 1 challengers whose upper confidence bound reaches the best move's lower bound.
+        """
+        fresh = [m for m in candidates if m not in self.values.keys()]
+        arms = [m for m in candidates if m in self.values.keys()]
+        if not arms:
+            return fresh
+
+        radius = {m: self.radius(m, len(rootMovesPv.get(m, [m]))) for m in arms}
+        best = max(arms, key=lambda m: self.values[m])
+        bestLower = self.values[best] - radius[best]
+
+        challengers = [m for m in arms if m != best and self.values[m] + radius[m] >= bestLower]
+        challengers.sort(key=lambda m: self.values[m] + radius[m], reverse=True)
+        chosen = set(fresh + [best] + challengers[:max(k - 1, 0)])
+        return [m for m in candidates if m in chosen]
+
+    def nodes(self, move: chess.Move, default_nodes: int, rootMovesPv: dict):
+        """Nodes for extending a move: more for the best move and for moves with uncertain evals."""
+        if move not in self.values.keys():
+            return int(default_nodes)
+
+        scale = 1.3 if self.values[move] >= max(self.values.values()) else 1.0
+        scale *= clamp(self.radius(move, len(rootMovesPv.get(move, [move]))) / SIGMA_PRIOR, 0.5, 2.0)
+        return int(default_nodes * scale)
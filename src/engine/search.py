@@ -1,430 +1,870 @@
+import threading
+import weakref
 from time import time as time_now
 
 import chess.engine
+import chess.polyglot
 
 import evaluate
-from evaluate import __engine__, init_engine
+from scheduler import BanditScheduler
 from search_h import *
 from timeman import *
 from utils import printf
 
-STOP_SEARCH = OPTTIME = MAXTIME = False
-IS_SEARCHING = False
+searchers = weakref.WeakSet()  # all Searchers, which share the engine pool
 
-npsAverage = RunningAverage(max_count=10, default_value=1000000 * option("Threads"))
 
-
-def search(rootPos: chess.Board, MAX_MOVES=GET_MAX_MOVES(), MAX_ITERS=GET_MAX_DEPTH(),
-           nodes: int = None, movetime: int = None, timeman: Time = Time()):
+class Searcher:
     """
-    Search a position by tracing the PV.
-    
-    param MAX_ITERS: Maximum number of iterations
-    param nodes: Maximum number of *total* nodes across all iterations
-    param time: Maximum time *per move*
+    A search with all of its state: the engine handle, NPS estimate, stop flags, time manager
+    and the previous search tree. Several Searchers can run at the same time in one process,
+    sharing the engine pool, e.g. to analyse different games.
     """
 
-    global STOP_SEARCH, npsAverage, IS_SEARCHING
-    global OPTTIME, MAXTIME
-
-    STOP_SEARCH = False
-    IS_SEARCHING = True
-
-    # start timer immediately for accuracy
-    root_time = last_output_time = time_now()
-
-    # initialise timeman object
-    assert timeman is not None
-    timeman.init(rootPos.turn, rootPos.ply())
-    if movetime:
-        timeman.optTime = timeman.maxTime = movetime
-    optTime = timeman.optTime
-    optTimeLeft = optTime
-    maxTime = timeman.maxTime
-
-    useTimeMan = optTime != 0 or maxTime != 0
-    startTime = time_now()
+    def __init__(self, output=printf):
+        self.output = output  # receives the UCI output of the search
+        self.handle = evaluate.EngineHandle()
+        self.controller = SearchController(self)
+        self.npsAverage = RunningAverage(max_count=10, default_value=1000000 * option("Threads"))
+        self.timeman: Time = None
+        self.maxTimer: threading.Timer = None  # interrupts the engines when maxTime is reached
+        self.maxTimeReached = False
+        # state of the last search: (pvRoot, rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt)
+        self.prevSearch = None
+        self.newGame = False  # the engines' hash tables may hold another game (see new_game)
+        searchers.add(self)
+
+    def search(self, *args, **kwargs):
+        """
+        Search a position by tracing the PV.
+
+        param MAX_ITERS: Maximum number of iterations
+        param nodes: Maximum number of *total* nodes across all iterations
+        param time: Maximum time *per move*
+        param ponder: Search in ponder mode, until ponderhit or stop
+        param infinite: Only send bestmove after stop, even if the search ends before
+        param searchmoves: Only search these root moves
+        param mate: Stop as soon as a mate in this many moves is found
+        """
+        try:
+            self._search(*args, **kwargs)
+        finally:
+            # a timer left running would stop the next search
+            self.cancel_max_timer()
+
+    def _search(self, rootPos: chess.Board, MAX_MOVES=GET_MAX_MOVES(), MAX_ITERS=GET_MAX_DEPTH(),
+                nodes: int = None, movetime: int = None, timeman: Time = None, ponder: bool = False,
+                searchmoves: list = None, mate: int = None, infinite: bool = False):
+
+        self.controller.begin(ponder, infinite)
+        STOP_SEARCH = OPTTIME = MAXTIME = False
+        self.maxTimeReached = False
+        pondering = ponder  # time management only starts on ponderhit
+        self.handle.allow()
+        self.handle.affinity.clear()  # the previous search had other root moves
+
+        # start timer immediately for accuracy
+        root_time = last_output_time = time_now()
+
+        # initialise timeman object
+        if timeman is None:
+            timeman = Time()
+        self.timeman = timeman
+        timeman.init(rootPos.turn, rootPos.ply())
+        if movetime:
+            timeman.optTime = timeman.maxTime = movetime
+        optTime = baseOptTime = timeman.optTime
+        optTimeLeft = optTime
+        # a fixed movetime is used in full; only a managed clock may stop early on a stable best move
+        clockManaged = not movetime and timeman.get_time(rootPos.turn) > 0
+        maxTime = timeman.maxTime
+
+        # When pondering, the time spent before ponderhit is also counted, like in Stockfish.
+        # This means we use less of our own clock after ponderhit.
+        useTimeMan = (optTime != 0 or maxTime != 0) and not ponder
+        startTime = time_now()
+        if useTimeMan:
+            self.start_max_timer(startTime, maxTime)
 
-    if optTime:
         if option("debug"):
-            printf(f"info string Timeman: Optimal time {optTime}ms")
-    if maxTime:
-        if option("debug"):
-            printf(f"info string Timeman: Maximum time {maxTime}ms")
-
-    # Initialise engine if not already initialised
-    if not engine_is_alive():
-        init_engine()
-
-    i = 1
-    total_nodes = 0
-    # npsAverage.clear()
-    default_nodes = setNodes(option("Nodes"), i)
-
-    rootMoves = list(rootPos.legal_moves)
-    rootMovesSize = len(list(rootMoves))
-
-    # Handle illegal moves
-    if rootMovesSize == 0 or not rootPos.is_valid():
-        printf("bestmove (none)")
-        IS_SEARCHING = False
-        return
-
-    # If we likely don't have enough time to search all moves, only use root engine eval
-    if useTimeMan:
-        # Special case: When we are under time control, and only one legal move, return immediately
-        if rootMovesSize == 1:
-            bestMove = rootMoves[0]
-            printf(f"info depth 0 nodes 0 time 0 pv {bestMove}")
-            printf(f"bestmove {bestMove}")
-            IS_SEARCHING = False
-            return
+            params = evaluate.cost_model.params()
+            if params is not None:
+                self.output(f"info string Cost model: latency {int(params[0] * 1000)}ms nps {int(params[1])}")
+        if optTime:
+            if option("debug"):
+                self.output(f"info string Timeman: Optimal time {optTime}ms")
+        if maxTime:
+            if option("debug"):
+                self.output(f"info string Timeman: Maximum time {maxTime}ms")
+
+        # Initialise engine if not already initialised
+        evaluate.ensure_engine()
+        if self.newGame:
+            self.new_game(rootPos)
+        self.handle.reset_stats()
+
+        i = 1
+        depth = 0  # seldepth of the latest result
+        total_nodes = 0
+        # self.npsAverage.clear()
+        default_nodes = setNodes(option("Nodes"), i, self.Nps())
+
+        rootMoves = list(rootPos.legal_moves)
+        # go searchmoves: illegal moves are ignored, and if none is legal we search all moves
+        if searchmoves and any(m in rootMoves for m in searchmoves):
+            rootMoves = [m for m in rootMoves if m in searchmoves]
+            searchRootMoves = rootMoves  # passed to the engine for the searches of the root position
+        else:
+            searchRootMoves = None
+        rootMovesSize = len(list(rootMoves))
 
-        if optTime <= 2000 or rootMovesSize * default_nodes > maxTime / 1000 * Nps():
-            # use the engine's timeman
-            info: chess.engine.InfoDict = __engine__(pos=rootPos, timeMan=timeman)
-            score = Value(info["score"])
-            nps = info["nps"] if "nps" in info else None
-            bestPv = info["pv"]
-            bestMove = bestPv[0]
-
-            printf(
-                f"info depth 0 seldepth {info['depth']} score cp {score.__uci_str__()} nodes {info['nodes']} "
-                f"{f'nps {nps} ' if nps else ''}"
-                f"time {int(info['time'] * 1000)} pv {utils.pv_to_uci(bestPv)}")
-            if len(bestPv) <= 1:
-                printf(f"bestmove {bestMove}")
-            else:
-                printf(f"bestmove {bestMove} ponder {bestPv[1]}")
-            IS_SEARCHING = False
+        # Handle illegal moves
+        if rootMovesSize == 0 or not rootPos.is_valid():
+            self.output("bestmove (none)")
+            self.controller.finish()
             return
 
-    info: chess.engine.InfoDict
-    if option("Nodes") != "auto":
-        info = __engine__(pos=rootPos, nodes=default_nodes)
-    else:
-        info = __engine__(pos=rootPos, movetime=1.0)
-
-    rootScore = Value(info["score"])
-    rootBestMove = info["pv"][0]
-    rootPv = info["pv"]
-    total_nodes += info["nodes"]
-    npsAverage.add(info["nps"])
-
-    printf(
-        f"info depth 0 seldepth {info['depth']} score cp {rootScore.__uci_str__()} nodes {total_nodes} nps {Nps()} "
-        f"time {int(info['time'] * 1000)} pv {utils.pv_to_uci(rootPv)}")
-
-    rootStm = rootPos.turn
-
-    # initialise dictionary for current position after each root move
-    # key: root move, value: position
-    rootMovesPos = {}
-    rootMovesDepth = {}
-    rootMovesEval = {}
-    rootMovesPv = {}
-    pruned_rootMoves = {}
-    rootMovesExtraNodes = {}
-
-    nextIterRecalcMoves = set()  # list of root moves that need to be recalculated next iter
-    prevPvRecalcIter = -MAX_DEPTH
-
-    bestValue = Value(-VALUE_INFINITE, rootStm)
-    bestMove = rootBestMove  # in case we have no time to search, at least return a move
-    bestMoveChanges = 0
-    prevBestValue = rootScore
-    prevBestMove = rootBestMove
-    prevRecalcIter = -MAX_DEPTH
-    recalcCount = 0
-
-    extraTimeIter = 0  # the iteration where we start using extra time
-
-    while i <= MAX_ITERS:
-        # Pre-iteration check:
-        # If we estimate that this iteration will take too long,
-        # Then we should stop searching in order to save time in timed games.
+        # If we likely don't have enough time to search all moves, only use root engine eval
         if useTimeMan:
-            # Estimate total nodes based on rootMovesSize
-            # Be relatively more aggressive as we can always stop later
-            if rootMovesSize * default_nodes > optTimeLeft / 1000 * Nps() * 2:
-                if not bestMove:
-                    bestMove = rootBestMove
-                try:
-                    ponderMove = rootMovesPv[bestMove][1]
-                except Exception:  # KeyError, IndexError, etc
-                    ponderMove = None
-                if ponderMove:
-                    printf(f"bestmove {bestMove} ponder {ponderMove}")
-                else:
-                    printf(f"bestmove {bestMove}")
-
-                if option("debug"):
-                    printf(f"info string Timeman: Early abort")
-                IS_SEARCHING = False
+            # Special case: When we are under time control, and only one legal move, return immediately
+            if rootMovesSize == 1:
+                bestMove = rootMoves[0]
+                self.output(f"info depth 0 nodes 0 time 0 pv {bestMove}")
+                self.print_bestmove(bestMove, [bestMove])
+                self.controller.finish()
                 return
 
-        # Increase default_nodes as iteration increases
-        default_nodes *= 1.0 + max(0.0, (0.0025 - 0.000033 * i) * i)
-        default_nodes = min(default_nodes, 10 * setNodes(option("Nodes"), i))  # cap at 10x default
-        if option("debug"):
-            printf(f"info string default_nodes: {default_nodes}")
+            if optTime <= 2000 or self.batch_time(rootMovesSize, default_nodes) > maxTime:
+                # use the engine's timeman
+                info: chess.engine.InfoDict = self.handle.analyse(pos=rootPos, timeMan=timeman,
+                                                                  root_moves=searchRootMoves)
+                if "score" not in info or not info.get("pv"):
+                    self.stopped_without_info(rootPos, rootMoves)
+                    return
+                score = Value(info["score"])
+                nps = info["nps"] if "nps" in info else None
+                bestPv = info["pv"]
+                bestMove = bestPv[0]
+
+                self.output(
+                    f"info depth 0 seldepth {info['depth']} score cp {score.__uci_str__()} nodes {info['nodes']} "
+                    f"{f'nps {nps} ' if nps else ''}"
+                    f"time {int(info['time'] * 1000)} pv {utils.pv_to_uci(bestPv)}")
+                self.print_bestmove(bestMove, bestPv)
+                self.controller.finish()
+                return
 
-        # Use more time for this iteration if bestMove is unstable
-        if bestMoveChanges > 0:
-            bestMoveInstability = 0.8 + 1.5 * math.log10(bestMoveChanges + 1) / option("Threads")
-            optTime = optTime * bestMoveInstability
-            if option("debug"):
-                printf(f"info string Timeman: bestMoveChanges {bestMoveChanges}, scale {bestMoveInstability}")
+        # With MultiPV > 1, the root search also screens the root moves (see below).
+        # Each line gets fewer nodes in a MultiPV search, so we give it more nodes in total.
+        multiPV = min(option("MultiPV"), rootMovesSize)
+        screenInfos = None
+        info: chess.engine.InfoDict
+        if option("Nodes") != "auto":
+            info = self.handle.analyse(pos=rootPos, nodes=default_nodes * max(1, multiPV // 2),
+                                       multipv=multiPV if multiPV > 1 else None, root_moves=searchRootMoves)
+        else:
+            info = self.handle.analyse(pos=rootPos, movetime=1.0, multipv=multiPV if multiPV > 1 else None,
+                                       root_moves=searchRootMoves)
+        if multiPV > 1:
+            screenInfos = info
+            info = screenInfos[0]
+        if "score" not in info or not info.get("pv"):
+            self.stopped_without_info(rootPos, rootMoves)
+            return
 
-        # reset constants
+        rootScore = Value(info["score"])
+        rootBestMove = info["pv"][0]
+        rootPv = info["pv"]
+        total_nodes += info["nodes"]
+        if info.get("nps"):  # results from the analysis database have no nps
+            self.npsAverage.add(info["nps"])
+
+        # UCI nps is the measured rate, Nps() is only an estimate for the node budgets
+        self.output(
+            f"info depth 0 seldepth {info['depth']} score cp {rootScore.__uci_str__()} nodes {total_nodes} "
+            f"nps {int(total_nodes / max(time_now() - root_time, 0.001))} "
+            f"time {int(info['time'] * 1000)} pv {utils.pv_to_uci(rootPv)}")
+
+        rootStm = rootPos.turn
+
+        # All root move lines are kept in a trie of PVs, which caches the position after every PV move.
+        # key: root move, value: the PvNode at the end of the move's PV
+        pvRoot = PvNode.root(rootPos)
+        rootMovesNode = {}
+        rootMovesDepth = {}
+        rootMovesSwing = {}  # key: root move, value: average eval change between iterations (cp)
+        rootMovesEval = {}
+        rootMovesPv = {}
+        pruned_rootMoves = {}
+        rootMovesExtraNodes = {}
+        tt = TranspositionTable()  # positions reached by any root move line
+        scheduler = BanditScheduler() if option("Scheduler") == "bandit" else None
+
+        # If this position lies on a PV of the previous search, continue from that PV
+        if option("Reuse tree"):
+            seed = self.reroot(rootPos)
+            if seed is not None:
+                rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt = seed
+                rootMovesPv = {move: pv for move, pv in rootMovesPv.items() if move in rootMoves}
+                for move, pv in rootMovesPv.items():
+                    rootMovesNode[move] = pvRoot.extend(pv)
+                    rootMovesPv[move] = rootMovesNode[move].pv()
+                if option("debug"):
+                    self.output(f"info string Reused {len(rootMovesPv)} PVs from the previous search")
+
+        # MultiPV screening: use the scores of the root search to order the root moves,
+        # and prune obviously bad moves before we start tracing PVs.
+        if screenInfos:
+            screened = []
+            for screenInfo in screenInfos:
+                if "pv" not in screenInfo or "score" not in screenInfo:
+                    continue
+                move = screenInfo["pv"][0]
+                screened.append(move)
+                if move not in rootMovesEval.keys():  # reused PVs are more accurate
+                    rootMovesEval[move] = Value(screenInfo["score"], rootStm)
+        if screenInfos and screened:
+            screened.sort(key=lambda m: int(rootMovesEval[m]), reverse=True)
+            rootMoves = screened + [m for m in rootMoves if m not in screened]
+
+            # moves outside the MultiPV window are no better than the worst screened move
+            min_prune_eval = prune_margin(rootMovesEval[screened[0]], 1)
+            worstScreened = rootMovesEval[screened[-1]]
+            for move in rootMoves:
+                if rootMovesEval.get(move, worstScreened) < min_prune_eval:
+                    pruned_rootMoves[move] = 0  # pruned before iteration 1
+                    if option("debug"):
+                        self.output(f"info string Screening | Pruned: {move} | Prune margin: {min_prune_eval}")
+            rootMovesSize = len([m for m in rootMoves if m not in pruned_rootMoves.keys()])
+
+        nextIterRecalcMoves = set()  # list of root moves that need to be recalculated next iter
+        truncatedMoves = set()  # root moves whose PV was truncated at the end of the previous iter
+        prevPvRecalcIter = -MAX_DEPTH
+
+        bestValue = Value(-VALUE_INFINITE, rootStm)
+        bestMove = rootBestMove  # in case we have no time to search, at least return a move
         bestMoveChanges = 0
-
-        # moves loop
-        for move in rootMoves:
-            # Update time management
-            elapsed_total = (time_now() - startTime) * 1000
-            optTimeLeft = optTime - elapsed_total
-
-            OPTTIME = useTimeMan and (OPTTIME or (optTimeLeft and optTimeLeft <= 0))
-            MAXTIME = useTimeMan and (MAXTIME or (maxTime and elapsed_total >= maxTime))
-            STOP_SEARCH = STOP_SEARCH or OPTTIME or MAXTIME
-            NODES_LIMIT_REACHED = nodes and total_nodes >= nodes
-
-            if STOP_SEARCH or NODES_LIMIT_REACHED:
-                # Timeman: if optTime has been reached but we are almost done
-                # (i.e. we can finish this iteration within maxTime)
-                # then we continue searching until we finish this iteration.
-                # However, estimate a bit more conservatively to avoid wasting time.
-                if useTimeMan:
-                    if not extraTimeIter and OPTTIME and not MAXTIME:
-                        move_i = rootMoves.index(move) + 1
-                        if (rootMovesSize - move_i) * default_nodes * 1.2 < maxTime / 1000 * Nps():
-                            if option("debug"):
-                                printf(f"info string Timeman: Extra time")
-                                extraTimeIter = i
-
-                if extraTimeIter < i:  # true as long as we did not use extra time
-                    STOP_SEARCH = OPTTIME = MAXTIME = False  # reset
-
-                    # Use previous iteration's best move since this iteration isn't complete
-                    bestMove = prevBestMove
-                    bestValue = prevBestValue
-
+        prevBestValue = rootScore
+        prevBestMove = rootBestMove
+        prevRecalcIter = -MAX_DEPTH
+        recalcCount = 0
+
+        extraTimeIter = 0  # the iteration where we start using extra time
+        stability = Stability()
+
+        while i <= MAX_ITERS:
+            # Choose the root moves to search in this iteration:
+            # either all of them, or the ones chosen by the bandit scheduler.
+            if scheduler is not None:
+                iterMoves = scheduler.select([m for m in rootMoves if not skip_pruned(m, pruned_rootMoves, i)],
+                                             rootMovesPv, max(2, evaluate.batch_size()))
+                iterSize = len(iterMoves)
+            else:
+                iterMoves = rootMoves
+                iterSize = rootMovesSize
+
+            # Pre-iteration check:
+            # If we estimate that this iteration will take too long,
+            # then we only search the best few root moves, as many as the remaining time allows.
+            # If not even that is possible, we stop searching in order to save time in timed games.
+            if useTimeMan:
+                # Estimate the time of this iteration based on iterSize
+                # Be relatively more aggressive as we can always stop later
+                if self.batch_time(iterSize, default_nodes) > optTimeLeft * 2:
+                    elapsed_total = (time_now() - startTime) * 1000
+                    budget = min(optTimeLeft * 2, maxTime - elapsed_total) if maxTime else optTimeLeft * 2
+                    k = self.affordable_calls(budget, default_nodes)
+                    if k >= 1 and rootMovesEval:
+                        iterMoves = top_moves([m for m in iterMoves if not skip_pruned(m, pruned_rootMoves, i)],
+                                              rootMovesEval, bestMove, k)
+                        iterSize = len(iterMoves)
+                        if option("debug"):
+                            self.output(f"info string Timeman: Partial iteration over {iterSize} moves")
+
+                if self.batch_time(iterSize, default_nodes) > optTimeLeft * 2:
+                    if not bestMove:
+                        bestMove = rootBestMove
                     try:
                         bestPv = rootMovesPv[bestMove]
                     except KeyError:
                         bestPv = [bestMove]
+                    self.print_bestmove(bestMove, bestPv)
+                    self.save_search(pvRoot, rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt)
 
-                    time_taken = time_now() - root_time
-                    printf(
-                        f"info depth {i} score cp {bestValue.__uci_str__()} nodes {total_nodes} nps {int(total_nodes / time_taken)} "
-                        f"time {int(time_taken * 1000)} pv {utils.pv_to_uci(bestPv)}")
-
-                    if len(bestPv) <= 1:
-                        printf(f"bestmove {bestMove}")
-                    else:
-                        printf(f"bestmove {bestMove} ponder {bestPv[1]}")
-                    IS_SEARCHING = False
+                    if option("debug"):
+                        self.output("info string Timeman: Early abort")
+                    self.controller.finish()
                     return
 
-            if move in pruned_rootMoves.keys():
-                pruned_iter = pruned_rootMoves[move]
-                if pruned_iter > 2 or pruned_iter >= i - 5:
-                    # if it is pruned late, then we can assume that it is a bad move
+            # Increase default_nodes as iteration increases
+            default_nodes *= 1.0 + max(0.0, (0.0025 - 0.000033 * i) * i)
+            default_nodes = min(default_nodes, 10 * setNodes(option("Nodes"), i, self.Nps()))  # cap at 10x default
+            if option("debug"):
+                self.output(f"info string default_nodes: {default_nodes}")
+
+            # Use more time for this iteration if bestMove is unstable.
+            # The scale applies to the original optTime, so that it does not compound over iterations.
+            optTime = baseOptTime
+            if bestMoveChanges > 0:
+                bestMoveInstability = 0.8 + 1.5 * math.log10(bestMoveChanges + 1) / option("Threads")
+                optTime = baseOptTime * bestMoveInstability
+                if option("debug"):
+                    self.output(f"info string Timeman: bestMoveChanges {bestMoveChanges}, scale {bestMoveInstability}")
+
+            # reset constants
+            bestMoveChanges = 0
+            iterSearched = []  # root moves with a result in this iteration
+
+            # moves loop
+            # First collect the lines to search in this iteration, then search them in batches of
+            # one line per engine in the pool, so that pruned moves do not leave engines idle.
+            # Results are merged in root move order, so the search stays deterministic.
+            jobs = []  # (move, pos, pv, value, IS_GAME_OVER, move_nodes)
+            for move in iterMoves:
+                if skip_pruned(move, pruned_rootMoves, i):
                     continue
-                else:
-                    if i - pruned_iter >= 2:
-                        pruned_rootMoves.pop(move)
 
-            # find position in rootMovesPos: almost like a transposition table, but not quite.
-            # if move is found, then we can continue searching from where we left off.
-            if move in rootMovesPos.keys():
-                pos = rootMovesPos[move]
-            else:
-                pos = rootPos.copy()
-                pos.push(move)
-                rootMovesPos[move] = pos
+                # find the end of the move's PV in the trie: we continue searching from where we left off.
+                if move not in rootMovesNode.keys():
+                    rootMovesNode[move] = pvRoot.child(move)
+                pos = rootMovesNode[move].pos
 
-            # UCI: if there hasn't been an output for 5 seconds, output currmove
-            if time_now() - last_output_time >= 5:
-                printf(f"info depth {i} currmove {move} currmovenumber {rootMoves.index(move) + 1} "
-                       f"nodes {total_nodes}")
-                last_output_time = time_now()
+                # nodes for this line
+                try:
+                    prevEval = rootMovesEval[move]
+                except KeyError:
+                    prevEval = None
 
-            # search
-            try:
-                prevEval = rootMovesEval[move]
-            except KeyError:
-                prevEval = None
-
-            promisingValue = promising(move, rootMovesEval, rootMovesSize, i, (move == bestMove), bestValue)
-            move_nodes = calc_nodes(move, bestValue, i, default_nodes, prevEval, (move == bestMove),
-                                    rootMovesExtraNodes, promisingValue)
-            value = Value()
-            if move in rootMovesPv.keys():
-                pv = rootMovesPv[move]
-            else:
-                pv = [move]
-
-            # Pre-handling of checkmate, stalemate, draw, etc.
-            IS_GAME_OVER = pos.is_game_over()
-            OUTCOME = pos.outcome()
-            if IS_GAME_OVER:
-                if OUTCOME.winner is None:
-                    value = Value(VALUE_DRAW)
+                if scheduler is not None:
+                    move_nodes = scheduler.nodes(move, default_nodes, rootMovesPv)
                 else:
-                    value = Value(VALUE_MATE, OUTCOME.winner)
-
-            # Before evaluating, first check if the max. move horizon has been reached
-            if len(pv) >= GET_MAX_HORIZON():
-                # If move horizon is reached, we give extra nodes to the move
-                if not move in rootMovesExtraNodes.keys():
-                    rootMovesExtraNodes[move] = 1.1
+                    promisingValue = promising(move, rootMovesEval, rootMovesSize, i, (move == bestMove), bestValue)
+                    move_nodes = calc_nodes(move, bestValue, i, default_nodes, prevEval, (move == bestMove),
+                                            rootMovesExtraNodes, promisingValue)
+                value = Value()
+                if move in rootMovesPv.keys():
+                    pv = rootMovesPv[move]
                 else:
-                    rootMovesExtraNodes[move] += 0.1
-                # And we recalculate this move later
-                nextIterRecalcMoves.add(move)
-
-                continue  # skip evaluating this move currently
+                    pv = [move]
+
+                # Pre-handling of checkmate, stalemate, draw, etc.
+                IS_GAME_OVER = rootMovesNode[move].game_over
+                if IS_GAME_OVER:
+                    OUTCOME = pos.outcome()
+                    if OUTCOME.winner is None:
+                        value = Value(VALUE_DRAW)
+                    else:
+                        value = Value(VALUE_MATE, OUTCOME.winner)
 
-            info: chess.engine.InfoDict = __engine__(pos=pos, nodes=move_nodes)
+                # Before evaluating, first check if the max. move horizon has been reached
+                if len(pv) >= GET_MAX_HORIZON():
+                    # If move horizon is reached, we give extra nodes to the move
+                    if not move in rootMovesExtraNodes.keys():
+                        rootMovesExtraNodes[move] = 1.1
+                    else:
+                        rootMovesExtraNodes[move] += 0.1
+                    # And we recalculate this move later
+                    nextIterRecalcMoves.add(move)
+
+                    continue  # skip evaluating this move currently
+
+                jobs.append((move, pos, pv, value, IS_GAME_OVER, move_nodes))
+
+            batchSize = evaluate.batch_size()
+            # The checks run once more after the last batch: an interrupted batch leaves the iteration incomplete
+            for batchStart in range(0, len(jobs) + batchSize, batchSize):
+                if jobs and batchStart >= len(jobs) and not self.handle.is_stopped():
+                    break  # the iteration is complete
+
+                if pondering and self.controller.ponder_hit.is_set():
+                    # The expected move was played: keep everything we found, and start managing time
+                    pondering = False
+                    useTimeMan = optTime != 0 or maxTime != 0
+                    if useTimeMan:
+                        self.start_max_timer(startTime, maxTime)
+
+                # Update time management
+                elapsed_total = (time_now() - startTime) * 1000
+                optTimeLeft = optTime - elapsed_total
+
+                OPTTIME = useTimeMan and (OPTTIME or (optTimeLeft and optTimeLeft <= 0))
+                MAXTIME = useTimeMan and (MAXTIME or self.maxTimeReached or (maxTime and elapsed_total >= maxTime))
+                STOP_SEARCH = self.controller.stop_requested.is_set() or OPTTIME or MAXTIME
+                NODES_LIMIT_REACHED = nodes and total_nodes >= nodes
+
+                if STOP_SEARCH or NODES_LIMIT_REACHED:
+                    # Timeman: if optTime has been reached but we are almost done
+                    # (i.e. we can finish this iteration within maxTime)
+                    # then we continue searching until we finish this iteration.
+                    # However, estimate a bit more conservatively to avoid wasting time.
+                    if useTimeMan:
+                        if not extraTimeIter and OPTTIME and not MAXTIME:
+                            if self.batch_time(len(jobs) - batchStart, default_nodes * 1.2) < maxTime - elapsed_total:
+                                if option("debug"):
+                                    self.output("info string Timeman: Extra time")
+                                extraTimeIter = i
 
-            new_pv = None
+                    # true as long as we did not use extra time, a stop always ends the search
+                    if extraTimeIter < i or MAXTIME or self.controller.stop_requested.is_set():
+                        OPTTIME = MAXTIME = False  # reset
+
+                        # Use previous iteration's best move since this iteration isn't complete,
+                        # unless a move searched in this iteration has clearly overtaken it.
+                        bestMove, bestValue = partial_best(prevBestMove, prevBestValue, iterSearched,
+                                                           rootMovesEval, rootMovesPv)
+
+                        try:
+                            bestPv = rootMovesPv[bestMove]
+                        except KeyError:
+                            bestPv = [bestMove]
+
+                        time_taken = time_now() - root_time
+                        self.output(
+                            f"info depth {i} score cp {bestValue.__uci_str__()} nodes {total_nodes} nps {int(total_nodes / time_taken)} "
+                            f"time {int(time_taken * 1000)} pv {utils.pv_to_uci(bestPv)}")
+
+                        self.print_bestmove(bestMove, bestPv)
+                        self.save_search(pvRoot, rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt)
+                        self.controller.finish()
+                        return
+
+                batch = jobs[batchStart:batchStart + batchSize]
+                if not batch:
+                    break
+
+                # UCI: if there hasn't been an output for 5 seconds, output currmove
+                if time_now() - last_output_time >= 5:
+                    self.output(f"info depth {i} currmove {batch[0][0]} "
+                                f"currmovenumber {rootMoves.index(batch[0][0]) + 1} nodes {total_nodes}")
+                    last_output_time = time_now()
+
+                # Lines that transpose into a position already searched by another line adopt its result,
+                # but a truncated line is searched again. Game over positions are not sent to the engine:
+                # their value is already known.
+                infos = [{"depth": 0, "nodes": 0} if job[4] else
+                         None if job[0] in truncatedMoves else tt.probe(job[1], job[5], line=job[0])
+                         for job in batch]
+                todo = [k for k in range(len(batch)) if infos[k] is None]
+                if option("debug"):
+                    for k in range(len(batch)):
+                        if infos[k] is not None and not batch[k][4]:
+                            self.output(f"info string Iteration {i} | Move: {batch[k][0]} | Transposition")
+
+                # every root move's line stays on the same engine, which has its previous search in its hash
+                for k, info in zip(todo, self.handle.analyse_many([{"pos": batch[k][1], "nodes": batch[k][5]}
+                                                                  for k in todo], keys=[batch[k][0] for k in todo])):
+                    infos[k] = info
+                    if not self.handle.is_stopped():  # interrupted results are incomplete
+                        tt.store(batch[k][1], info, batch[k][5], line=batch[k][0])
+
+                for (move, pos, pv, value, IS_GAME_OVER, move_nodes), info in zip(batch, infos):
+                    if "score" not in info and not IS_GAME_OVER:
+                        continue  # interrupted before the engine sent any info: keep the previous result
+
+                    new_pv = None
+                    try:
+                        total_nodes += info["nodes"]
+                        new_pv = info["pv"]
+                        new_pv = new_pv[:MAX_MOVES]
+                    except KeyError:
+                        pass
+
+                    # Update PV: only the new moves are played, from the cached position at the end of the PV
+                    if new_pv:
+                        rootMovesNode[move] = rootMovesNode[move].extend(new_pv)
+                    rootMovesPv[move] = rootMovesNode[move].pv()
+
+                    depth = info["depth"]
+                    rootMovesDepth[move] = depth
+
+                    if not IS_GAME_OVER:
+                        value = Value(info["score"], pos.turn)
+
+                    # Convert value to our pov
+                    value = value.to_pov(rootStm)
+
+                    # update rootMovesEval, and how much it changed
+                    if move in rootMovesEval.keys():
+                        swing = abs(int(value) - int(rootMovesEval[move]))
+                        rootMovesSwing[move] = (rootMovesSwing.get(move, swing) + swing) / 2
+                    rootMovesEval[move] = value
+                    iterSearched.append(move)
+                    if scheduler is not None:
+                        scheduler.update(move, int(value))
+
+                    if option("debug"):
+                        self.output(f"info string Iteration {i} | Move: {move} | Eval: {value} | "
+                                    f"POV: {value.to_pov(rootStm)}")
+
+                    if value > bestValue:
+                        if move != bestMove:
+                            bestMoveChanges += 1
+                        bestValue = value
+                        bestMove = move
+
+            # proper UCI formatting
+            time_taken = time_now() - root_time
             try:
-                total_nodes += info["nodes"]
-                new_pv = info["pv"]
-                new_pv = new_pv[:MAX_MOVES]
-                pv.extend(new_pv)
-            except KeyError:
+                if info["nps"]:
+                    self.npsAverage.add(info["nps"])
+            except Exception:
                 pass
 
-            # Update PV
-            rootMovesPv[move] = pv
+            if i <= 10 or i - prevPvRecalcIter > 2:
+                self.output(
+                    f"info depth {i} seldepth {depth} score cp {bestValue.__uci_str__()} nodes {total_nodes} "
+                    f"nps {int(total_nodes / time_taken)} "
+                    f"time {int(time_taken * 1000)} pv {utils.pv_to_uci(rootMovesPv.get(bestMove, [bestMove]))}")
+            else:
+                # if current or last iter's best move was recalculated, do not output unsafe info
+                self.output(
+                    f"info depth {i} seldepth {depth} nodes {total_nodes} nps {int(total_nodes / time_taken)} "
+                    f"time {int(time_taken * 1000)}")
+
+            # Stop early if the best move has been stable, instead of using all of optTime
+            others = [int(v) for m, v in rootMovesEval.items() if m != bestMove]
+            stability.update(bestMove, int(bestValue), int(prevBestValue), max(others) if others else None)
+            if useTimeMan and clockManaged and stability.scale() < 1.0:
+                elapsed_total = (time_now() - startTime) * 1000
+                if elapsed_total >= optTime * stability.scale():
+                    if option("debug"):
+                        self.output(f"info string Timeman: Stable best move, stop at "
+                                    f"{int(stability.scale() * 100)}% of optimal time")
+                    self.print_bestmove(bestMove, rootMovesPv.get(bestMove, [bestMove]))
+                    self.save_search(pvRoot, rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt)
+                    self.controller.finish()
+                    return
+
+            # go mate: stop as soon as we have found a mate that is short enough
+            mateMoves = mate_moves(bestValue, rootMovesPv.get(bestMove, [bestMove])) if mate else None
+            if mateMoves is not None and mateMoves <= mate:
+                if option("debug"):
+                    self.output(f"info string Found mate in {mateMoves}")
+                break
+
+            prevBestValue = bestValue
+            prevBestMove = bestMove
+
+            # Update pruned moves after we finish searching all root moves
+            for move in rootMovesEval.keys():
+                v = rootMovesEval[move]
+                min_prune_eval = prune_margin(bestValue, i)
+                if v < min_prune_eval:
+                    pruned_rootMoves[move] = i
+                    if option("debug"):
+                        self.output(f"info string Iteration {i} | Pruned: {move} | Prune margin: {min_prune_eval}")
+
+            # Update moves list size
+            rootMovesSize = [1 for m in rootMoves if m not in pruned_rootMoves.keys()].__len__()
+
+            if rootMovesSize / len(rootMoves) < 0.2:
+                # Extreme case: only few moves remains after pruning
+
+                # Give extra nodes to the best move
+                if bestMove not in rootMovesExtraNodes.keys():
+                    rootMovesExtraNodes[bestMove] = 1.2  # initial bonus multiplier
+                else:
+                    rootMovesExtraNodes[bestMove] += 0.1
+
+            # Allow re-calculation of move PVs
+            if ((rootMovesSize <= 1 and i - prevRecalcIter >= recalcCount - 1) or
+                rootMovesSize / len(rootMoves) <= max(0.02, 0.2 - recalcCount * 0.02) or
+                bestValue - prevBestValue <= -(25 + i / 2) or (i <= 10 and bestValue - rootScore <= -(50 + i))) \
+                    and i - prevRecalcIter >= 5 + 2 * recalcCount:
+                # Re-calculate the unstable lines. The other lines keep their PVs and pruning state.
+                nextIterRecalcMoves |= unstable_moves(rootMoves, rootMovesSwing, rootMovesPv, rootMovesDepth)
+                prevRecalcIter = i
+                recalcCount += 1
+
+            truncatedMoves = set()
+            if len(nextIterRecalcMoves) > 0:
+                for m in nextIterRecalcMoves:
+                    if m not in rootMovesPv.keys():
+                        continue  # not searched yet, e.g. pruned by MultiPV screening
+
+                    # Delete the end of the PV, depending on how promising the move is.
+                    # The more promising it is, the more we delete to allow more accurate calculation.
+                    p = promising(m, rootMovesEval, rootMovesSize, i, (m == bestMove),
+                                  bestValue)  # float from 0 to 1
+                    p = min(p, 0.85)
+
+                    # Extra bonus if PV is long
+                    p += len(rootMovesPv[m]) / 200
+                    # allow deletion of the entire PV only if i <= 30
+                    # p = 0 -> delete nothing, p = 1 -> delete entire PV
+                    max_p = 0.9 - 0.005 * i + 0.2 * math.log10(i / 30) if i > 30 else 0.8 + 0.0066 * i
+                    p = min(max_p, 1.0)
+
+                    # delete PV
+                    del_moves = round(len(rootMovesPv[m]) * (1 - p))
+                    del_moves = max(del_moves, 1 + i // 20)  # cannot delete root move
+                    if option("debug"):
+                        self.output(f"info string Iteration {i} | Kept {del_moves} moves in {m}")
+                    # the truncated part of the PV is dropped from the trie
+                    rootMovesNode[m] = rootMovesNode[m].truncate(del_moves)
+                    truncatedMoves.add(m)
+                    rootMovesPv[m] = rootMovesNode[m].pv()
+                    pruned_rootMoves.pop(m, None)
+
+                # Increase default_nodes, by how much of the search is re-calculated
+                default_nodes += int(self.Nps() * 0.10 * len(nextIterRecalcMoves) / len(rootMoves))
+                rootMovesSize = len([m for m in rootMoves if m not in pruned_rootMoves.keys()])
+                # The evals of re-calculated lines are out of date, so only the other lines count for bestValue
+                bestValue = max([rootMovesEval[m] for m in rootMovesEval.keys()
+                                 if m not in nextIterRecalcMoves and m not in pruned_rootMoves.keys()],
+                                key=int, default=Value(-VALUE_INFINITE, rootStm))
+                if bestMove in nextIterRecalcMoves:
+                    prevPvRecalcIter = i
+                nextIterRecalcMoves.clear()
+
+            # end of this iteration
+            i += 1
+
+        # After search is finished
+        try:
+            bestPv = rootMovesPv[bestMove]
+        except KeyError:
+            bestPv = [bestMove]
+        self.print_bestmove(bestMove, bestPv)
+        self.save_search(pvRoot, rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt)
+
+        self.controller.finish()
+
+    def stopped_without_info(self, rootPos: chess.Board, rootMoves: list):
+        """
+        The search was stopped before the engine sent any info for the root position.
+        We still send bestmove: the best move of the previous search if it searched this position,
+        otherwise the first legal move.
+        """
+        rootMovesPv = rootMovesEval = {}
+        if self.prevSearch is not None and \
+                chess.polyglot.zobrist_hash(self.prevSearch[0].pos) == chess.polyglot.zobrist_hash(rootPos):
+            rootMovesPv, rootMovesEval = self.prevSearch[1], self.prevSearch[2]
+        else:
+            seed = self.reroot(rootPos)
+            if seed is not None:
+                rootMovesPv, rootMovesEval = seed[0], seed[1]
+
+        candidates = [m for m in rootMovesPv.keys() if m in rootMoves]
+        if candidates:
+            bestMove = max(candidates, key=lambda m: int(rootMovesEval[m]) if m in rootMovesEval else -VALUE_INFINITE)
+            bestPv = rootMovesPv[bestMove]
+        else:
+            bestMove = rootMoves[0]
+            bestPv = [bestMove]
+        self.output(f"info depth 0 nodes 0 time 0 pv {utils.pv_to_uci(bestPv)}")
+        self.print_bestmove(bestMove, bestPv)
+        self.controller.finish()
+
+    def save_search(self, pvRoot: PvNode, rootMovesPv: dict, rootMovesEval: dict, rootMovesExtraNodes: dict,
+                    tt: TranspositionTable):
+        """Keep the state of a finished search, so that the next search can reuse it."""
+        self.prevSearch = (pvRoot, rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt)
+
+    def clear_search(self):
+        """Called for a new game. The previous search and the engines' hash tables are only cleared
+        by the next search, if its position does not continue from the previous search."""
+        self.newGame = True
+
+    def new_game(self, rootPos: chess.Board):
+        """
+        The first search after a new game: GUIs also send ucinewgame e.g. before analysing the same position again,
+        so the previous search and the engines' hash tables are only cleared if the root has changed.
+        """
+        self.newGame = False
+        if self.prevSearch is not None:
+            prevRoot = self.prevSearch[0].pos
+            if chess.polyglot.zobrist_hash(prevRoot) == chess.polyglot.zobrist_hash(rootPos) \
+                    or self.reroot(rootPos) is not None:
+                return
+        self.prevSearch = None
+        # the engines are shared: their hash tables also serve the other searches that are running
+        if any(s is not self and s.controller.searching() for s in list(searchers)):
+            return
+        evaluate.clear_hash()
+        if option("debug"):
+            self.output("info string New game: cleared the engines' hash tables")
+
+    def reroot(self, rootPos: chess.Board):
+        """
+        If rootPos lies on a PV of the previous search, return the state of the previous search
+        re-rooted at rootPos: (rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt).
+        Otherwise, return None.
+        """
+        if self.prevSearch is None:
+            return None
+        prevPvRoot, prevRootMovesPv, prevRootMovesEval, prevRootMovesExtraNodes, tt = self.prevSearch
+
+        # rootPos can only be found at this many moves into each PV
+        plies = rootPos.ply() - prevPvRoot.pos.ply()
+        if plies <= 0:
+            return None
+        key = chess.polyglot.zobrist_hash(rootPos)
+
+        rootMovesPv = {}
+        rootMovesEval = {}
+        rootMovesExtraNodes = {}
+        for prevMove, pv in prevRootMovesPv.items():
+            if len(pv) <= plies:
+                continue
+
+            # the positions along the PV are cached in the previous trie
+            node = prevPvRoot.extend(pv[:plies])
+            if node.length == plies:
+                if chess.polyglot.zobrist_hash(node.pos) != key:
+                    continue
 
-            depth = info["depth"]
-            if depth not in rootMovesDepth.keys():
-                rootMovesDepth[move] = depth
+                # The rest of the PV is the PV of a root move in the new position.
+                # If several PVs transpose to the same root move, keep the longest one.
+                move = pv[plies]
+                if move in rootMovesPv.keys() and len(rootMovesPv[move]) >= len(pv) - plies:
+                    continue
+                rootMovesPv[move] = pv[plies:]
+                if prevMove in prevRootMovesEval.keys():
+                    rootMovesEval[move] = prevRootMovesEval[prevMove].to_pov(rootPos.turn)
+                if prevMove in prevRootMovesExtraNodes.keys():
+                    rootMovesExtraNodes[move] = prevRootMovesExtraNodes[prevMove]
+
+        if not rootMovesPv:
+            return None
+        return rootMovesPv, rootMovesEval, rootMovesExtraNodes, tt
+
+    def print_bestmove(self, bestMove: chess.Move, bestPv: list):
+        """Output the best move (with a ponder move if possible) at the end of the search."""
+        self.cancel_max_timer()
+
+        # While pondering, bestmove can only be sent after ponderhit or stop
+        self.controller.bestmove_allowed.wait()
+
+        if evaluate.eval_cache.enabled():
+            self.output(f"info string Eval cache: "
+                        f"{evaluate.eval_cache.stats_str(self.handle.cache_hits, self.handle.cache_misses)}")
+        if evaluate.analysis_db is not None:
+            self.output(f"info string Analysis DB: hits {self.handle.db_hits}")
+
+        if len(bestPv) <= 1:
+            self.output(f"bestmove {bestMove}")
+        else:
+            self.output(f"bestmove {bestMove} ponder {bestPv[1]}")
 
-            if not IS_GAME_OVER:
-                value = Value(info["score"], pos.turn)
+        # after bestmove, so that it does not cost any time on the clock
+        evaluate.save_cost_model()
+        evaluate.save_analysis_db()
 
-            # Convert value to our pov
-            value = value.to_pov(rootStm)
+    def start_max_timer(self, startTime: float, maxTime: int):
+        """Interrupt the engines as soon as maxTime (ms) has passed since startTime."""
+        self.cancel_max_timer()
+        if not maxTime:
+            return
+        timer = threading.Timer(max(0.0, startTime + maxTime / 1000 - time_now()), lambda: self.on_max_time(timer))
+        timer.daemon = True
+        self.maxTimer = timer
+        timer.start()
+
+    def cancel_max_timer(self):
+        if self.maxTimer is not None:
+            self.maxTimer.cancel()
+            self.maxTimer = None
+
+    def on_max_time(self, timer: threading.Timer):
+        if timer is not self.maxTimer:
+            return  # cancelled while it was firing
+        self.maxTimeReached = True
+        self.handle.stop()
+
+    def Nps(self):
+        """Estimated nodes per second, aggregated over all engines in the pool."""
+        params = evaluate.cost_model.params()
+        nps = params[1] if params is not None else self.npsAverage.value()
+        nps = int(nps) * evaluate.pool_size()
+        nps = max(nps, 10000)
+        return nps
+
+    def batch_time(self, calls: int, nodes: float):
+        """Estimated time (ms) of `calls` engine calls of `nodes` nodes each, shared out over the pool.
+        Unlike Nps() alone, this includes the fixed latency of every call."""
+        return math.ceil(calls / evaluate.pool_size()) * self.call_time(nodes)
+
+    def call_time(self, nodes: float):
+        """Estimated time (ms) of a single engine call."""
+        params = evaluate.cost_model.params()
+        latency = params[0] if params is not None else 0.0
+        nps = self.Nps() / evaluate.pool_size()  # of a single engine
+        return (latency + nodes / nps) * 1000
+
+    def affordable_calls(self, budget: float, nodes: float):
+        """Number of engine calls of `nodes` nodes each that fit in budget (ms), using the whole pool."""
+        if budget <= 0:
+            return 0
+        return int(budget // self.call_time(nodes)) * evaluate.pool_size()
+
+
+def top_moves(candidates: list, rootMovesEval: dict, bestMove: chess.Move, k: int):
+    """
+    The best k root moves by their current eval, in the order of candidates.
+    The best move is always included, and moves that were never searched come last.
+    """
+    ranked = sorted(candidates, key=lambda m: (m == bestMove, m in rootMovesEval.keys(),
+                                               int(rootMovesEval[m]) if m in rootMovesEval.keys() else 0),
+                    reverse=True)
+    chosen = set(ranked[:k])
+    return [m for m in candidates if m in chosen]
 
-            # update rootMovesEval
-            rootMovesEval[move] = value
 
-            if option("debug"):
-                printf(f"info string Iteration {i} | Move: {move} | Eval: {value} | POV: {value.to_pov(rootStm)}")
+def unstable_moves(rootMoves: list, rootMovesSwing: dict, rootMovesPv: dict, rootMovesDepth: dict):
+    """
+    The root moves whose lines are worth re-calculating: lines whose eval swings between iterations,
+    long PVs, and lines that the engine searched less deeply than the others.
+    The most unstable line is always included.
+    """
+    searched = [m for m in rootMoves if m in rootMovesPv.keys()]
+    if not searched:
+        return set()
+    depths = sorted(rootMovesDepth.get(m, 0) for m in searched)
+    medianDepth = max(depths[len(depths) // 2], 1)
 
-            if new_pv:
-                rootMovesPos[move] = utils.push_pv(pos, new_pv, info)
+    def instability(m: chess.Move):
+        swing = rootMovesSwing.get(m, 0) / RECALC_SWING
+        length = len(rootMovesPv[m]) / GET_MAX_HORIZON()
+        shallow = max(medianDepth - rootMovesDepth.get(m, medianDepth), 0) / medianDepth
+        return swing + length + shallow
 
-            if value > bestValue:
-                if move != bestMove:
-                    bestMoveChanges += 1
-                bestValue = value
-                bestMove = move
+    scores = {m: instability(m) for m in searched}
+    unstable = {m for m in searched if scores[m] >= 1.0}
+    unstable.add(max(searched, key=lambda m: scores[m]))
+    return unstable
 
-        # proper UCI formatting
-        time_taken = time_now() - root_time
-        try:
-            if info["nps"]:
-                npsAverage.add(info["nps"])
-        except Exception:
-            pass
-
-        if i <= 10 or i - prevPvRecalcIter > 2:
-            printf(
-                f"info depth {i} seldepth {depth} score cp {bestValue.__uci_str__()} nodes {total_nodes} nps {Nps()} "
-                f"time {int(time_taken * 1000)} pv {utils.pv_to_uci(rootMovesPv[bestMove])}")
-        else:
-            # if current or last iter's best move was recalculated, do not output unsafe info
-            printf(
-                f"info depth {i} seldepth {depth} nodes {total_nodes} nps {Nps()} time {int(time_taken * 1000)}")
-
-        prevBestValue = bestValue
-        prevBestMove = bestMove
-
-        # Update pruned moves after we finish searching all root moves
-        for move in rootMovesEval.keys():
-            v = rootMovesEval[move]
-            min_prune_eval = prune_margin(bestValue, i)
-            if v < min_prune_eval:
-                pruned_rootMoves[move] = i
-                if option("debug"):
-                    printf(f"info string Iteration {i} | Pruned: {move} | Prune margin: {min_prune_eval}")
 
-        # Update moves list size
-        rootMovesSize = [1 for m in rootMoves if m not in pruned_rootMoves.keys()].__len__()
+def mate_moves(value: Value, pv: list):
+    """
+    The number of our moves until mate along a root move line, or None if the line does not lead to our mate.
+    value is the eval at the end of pv, from the root side to move's POV.
+    """
+    if int(value) <= VALUE_MATE - MAX_DEPTH:
+        return None
+    # our moves in the PV, plus the moves to mate found by the engine at the end of it
+    return (len(pv) + 1) // 2 + VALUE_MATE - int(value)
 
-        if rootMovesSize / len(rootMoves) < 0.2:
-            # Extreme case: only few moves remains after pruning
 
-            # Give extra nodes to the best move
-            if bestMove not in rootMovesExtraNodes.keys():
-                rootMovesExtraNodes[bestMove] = 1.2  # initial bonus multiplier
-            else:
-                rootMovesExtraNodes[bestMove] += 0.1
-
-        # Allow re-calculation of move PVs
-        if ((rootMovesSize <= 1 and i - prevRecalcIter >= recalcCount - 1) or
-            rootMovesSize / len(rootMoves) <= max(0.02, 0.2 - recalcCount * 0.02) or
-            bestValue - prevBestValue <= -(25 + i / 2) or (i <= 10 and bestValue - rootScore <= -(50 + i))) \
-                and i - prevRecalcIter >= 5 + 2 * recalcCount:
-            # Every move needs to be re-calculated
-            nextIterRecalcMoves = set(rootMoves)
-
-        if len(nextIterRecalcMoves) > 0:
-            for m in nextIterRecalcMoves:
-                # Delete the end of the PV, depending on how promising the move is.
-                # The more promising it is, the more we delete to allow more accurate calculation.
-                p = promising(m, rootMovesEval, rootMovesSize, i, (m == bestMove),
-                              bestValue)  # float from 0 to 1
-                p = min(p, 0.85)
-
-                # Extra bonus if PV is long
-                p += len(rootMovesPv[m]) / 200
-                # allow deletion of the entire PV only if i <= 30
-                # p = 0 -> delete nothing, p = 1 -> delete entire PV
-                max_p = 0.9 - 0.005 * i + 0.2 * math.log10(i / 30) if i > 30 else 0.8 + 0.0066 * i
-                p = min(max_p, 1.0)
-
-                # delete PV
-                del_moves = round(len(rootMovesPv[m]) * (1 - p))
-                del_moves = max(del_moves, 1 + i // 20)  # cannot delete root move
-                if option("debug"):
-                    printf(f"info string Iteration {i} | Kept {del_moves} moves in {m}")
-                rootMovesPv[m] = rootMovesPv[m][:del_moves]
-
-                # update position
-                rootMovesPos[m] = utils.push_pv(rootPos.copy(), rootMovesPv[m])
-
-            # Restart the search, with increased default_nodes
-            default_nodes += int(Nps() * 0.10)
-            rootMovesSize = len(list(rootMoves))
-            pruned_rootMoves = {}
-            bestValue = Value(-VALUE_INFINITE, rootStm)
-            prevRecalcIter = i
-            recalcCount += 1
-            if bestMove in nextIterRecalcMoves:
-                prevPvRecalcIter = i
-            nextIterRecalcMoves.clear()
-
-        # end of this iteration
-        i += 1
-
-    # After search is finished
-    try:
-        bestPv = rootMovesPv[bestMove]
-    except KeyError:
-        bestPv = [bestMove]
-    if len(bestPv) <= 1:
-        printf(f"bestmove {bestMove}")
-    else:
-        printf(f"bestmove {bestMove} ponder {bestPv[1]}")
+def partial_best(prevBestMove: chess.Move, prevBestValue: Value, iterSearched: list, rootMovesEval: dict,
+                 rootMovesPv: dict):
+    """
+    Decide the best move when the search stops in the middle of an iteration.
+    The previous iteration's best move is kept, unless a move searched in this iteration beats it
+    by PARTIAL_MARGIN, with a PV at least as long as the best move's.
+    Returns (bestMove, bestValue).
+    """
+    bestMove, bestValue = prevBestMove, prevBestValue
+    if prevBestMove in iterSearched:
+        bestValue = rootMovesEval[prevBestMove]  # the newer, deeper result
+    bestPvLen = len(rootMovesPv.get(prevBestMove, []))
 
-    IS_SEARCHING = False
+    for move in iterSearched:
+        if move == prevBestMove or len(rootMovesPv.get(move, [])) < bestPvLen:
+            continue
+        if int(rootMovesEval[move]) - int(bestValue) >= PARTIAL_MARGIN:
+            bestMove, bestValue = move, rootMovesEval[move]
+    return bestMove, bestValue
 
 
 def prune_margin(bestValue: Value, i: int):
@@ -454,6 +894,22 @@ def prune_margin(bestValue: Value, i: int):
     return min(m, bestValue - 10)
 
 
+def skip_pruned(move: chess.Move, pruned_rootMoves: dict, i: int):
+    """
+    Return True if a pruned root move should not be searched in iteration i.
+    Moves pruned early are searched again after a few iterations.
+    """
+    if move in pruned_rootMoves.keys():
+        pruned_iter = pruned_rootMoves[move]
+        if pruned_iter > 2 or pruned_iter >= i - 5:
+            # if it is pruned late, then we can assume that it is a bad move
+            return True
+        else:
+            if i - pruned_iter >= 2:
+                pruned_rootMoves.pop(move)
+    return False
+
+
 def calc_nodes(move: chess.Move, bestValue: Value, i: int, default_nodes: int, prevEval
                , is_best: bool, rootMovesExtraNodes: dict, promisingValue):
     """
@@ -487,7 +943,7 @@ def calc_nodes(move: chess.Move, bestValue: Value, i: int, default_nodes: int, p
     return nodes
 
 
-def setNodes(v, i: int, num_moves: int = 20):
+def setNodes(v, i: int, nps: int, num_moves: int = 20):
     """Set default_nodes based on UCI input.
     This value is either an integer or 'auto'."""
     if type(v) == int:
@@ -498,7 +954,7 @@ def setNodes(v, i: int, num_moves: int = 20):
         div = (6.0 + scale - 2.5 * math.log10(option("Threads"))
                - 5.0 * math.log10(i) + 5.0 * math.log10(num_moves))
         div = clamp(div, 0.50, 32.0)
-        nodes = int(Nps() / div)
+        nodes = int(nps / div)
         return nodes
 
 
@@ -531,25 +987,124 @@ def promising(move: chess.Move, rootMovesEval: dict, rootMovesSize: int, i: int,
     return final_score
 
 
-def stop_search(optTime=False, maxTime=False):
-    global STOP_SEARCH, OPTTIME, MAXTIME
-    STOP_SEARCH = True
+class SearchController:
+    """
+    Starts and stops the searches of a Searcher, which run in their own thread.
+    All waiting is done on threading events, so it costs no CPU time that the engines could use.
+    """
+
+    def __init__(self, searcher: Searcher):
+        self.searcher = searcher
+        self.lock = threading.Lock()  # go, stop and ponderhit are handled one at a time
+        self.thread: threading.Thread = None
+        self.idle = threading.Event()  # no search is running
+        self.stop_requested = threading.Event()
+        self.ponder_hit = threading.Event()
+        self.bestmove_allowed = threading.Event()  # cleared while pondering, until ponderhit or stop
+        self.infinite = False  # go infinite: bestmove is only allowed after stop
+        self.idle.set()
+        self.bestmove_allowed.set()
+
+    def searching(self):
+        return not self.idle.is_set()
+
+    def _reset(self, ponder: bool, infinite: bool = False):
+        self.idle.clear()
+        self.stop_requested.clear()
+        self.ponder_hit.clear()
+        self.infinite = infinite
+        if ponder or infinite:
+            self.bestmove_allowed.clear()
+        else:
+            self.bestmove_allowed.set()
+
+    def begin(self, ponder: bool, infinite: bool = False):
+        """Called by search() when it starts, in case it was called directly rather than through go()."""
+        if self.idle.is_set():  # go() has already reset everything
+            with self.lock:
+                if self.idle.is_set():
+                    self._reset(ponder, infinite)
+
+    def finish(self):
+        """Called when the search has sent bestmove."""
+        self.idle.set()
+
+    def go(self, **kwargs):
+        """Start searcher.search(**kwargs) in a new thread. A search that is still running is stopped first."""
+        with self.lock:
+            if self.searching():
+                self._request_stop()
+                self.idle.wait()
+            # reset before the thread starts, so that a stop that comes right after go is never lost
+            self._reset(kwargs.get("ponder", False), kwargs.get("infinite", False))
+            self.thread = threading.Thread(target=self._run, kwargs=kwargs)
+            self.thread.start()
+
+    def _run(self, **kwargs):
+        try:
+            self.searcher.search(**kwargs)
+        finally:
+            self.finish()
+
+    def _request_stop(self):
+        self.stop_requested.set()
+        self.bestmove_allowed.set()
+        # don't wait for the engines to finish their current searches
+        self.searcher.handle.stop()
+
+    def request_stop(self):
+        """Ask the search to stop as soon as possible, without waiting for it."""
+        with self.lock:
+            if self.searching():
+                self._request_stop()
+
+    def stop(self, timeout: float = None):
+        """Stop the search, and wait until it has sent bestmove."""
+        self.request_stop()
+        return self.wait(timeout)
+
+    def wait(self, timeout: float = None):
+        """Wait until no search is running. Returns False on timeout."""
+        return self.idle.wait(timeout)
 
-    if optTime:
-        OPTTIME = True
-    if maxTime:
-        MAXTIME = True
+    def ponderhit(self):
+        """The opponent played the expected move: continue the search with time management."""
+        with self.lock:
+            self.ponder_hit.set()
+            if not self.infinite:
+                self.bestmove_allowed.set()
+
+
+# the searcher used by the UCI interface and by the functions below
+searcher = Searcher()
+controller = searcher.controller
+
+
+def search(*args, **kwargs):
+    return searcher.search(*args, **kwargs)
+
+
+def clear_search():
+    searcher.clear_search()
+
+
+def stop_search():
+    controller.request_stop()
+
+
+def ponderhit():
+    controller.ponderhit()
+
+
+def wait_searches():
+    """Wait until no Searcher is searching, e.g. before the engine pool is rebuilt."""
+    for s in list(searchers):
+        s.controller.wait()
 
 
 def engine_is_alive():
-    try:
-        evaluate.engine.ping()
-        return True
-    except Exception:
-        return False
+    return evaluate.is_alive()
 
 
 def Nps():
-    nps = int(npsAverage.value())
-    nps = max(nps, 10000)
-    return nps
+    return searcher.Nps()
@@ -1,5 +1,6 @@
 import chess
 import chess.engine
+import chess.polyglot
 
 import utils as utils
 from ucioption import option
@@ -13,6 +14,8 @@ VALUE_MATE = 100000
 VALUE_DRAW = 0
 MAX_DEPTH = 256
 MAX_HORIZON = 30
+RECALC_SWING = 30  # eval swing (cp) between iterations that alone makes a line worth re-calculating
+PARTIAL_MARGIN = 10  # a move searched in an unfinished iteration must beat the best move by this much (cp)
 
 
 class Value:
@@ -127,12 +130,15 @@ class RunningAverage:
     default_value = 0
     total = 0
     count = 0
-    values = deque()
+    values: deque = None
 
     def __init__(self, max_count: int = 1024, default_value: int = 0):
         assert max_count > 0
         self.max_count = max_count
         self.default_value = default_value
+        self.total = 0
+        self.count = 0
+        self.values = deque()  # per instance: a class level deque would be shared by all averages
 
     def add(self, value):
         self.total += value
@@ -157,6 +163,147 @@ class RunningAverage:
         return int(self.value())
 
 
+class TranspositionTable:
+    """
+    Position-keyed table shared by all root move lines in a search.
+    When a line reaches a position that another line has already searched, it can adopt
+    the stored continuation and score instead of calling the engine again.
+    """
+    table: dict = None  # key: zobrist hash, value: (info, nodes, line that stored it)
+
+    def __init__(self):
+        self.table = {}
+
+    def probe(self, pos: chess.Board, nodes: int, line=None):
+        """Return the stored InfoDict if another line searched it with at least `nodes` nodes.
+        A line never adopts its own result: after its PV was truncated, it must be searched again.
+        Entries whose continuation runs into a repetition of this line's history are not used,
+        since the other line could not see that repetition."""
+        entry = self.table.get(chess.polyglot.zobrist_hash(pos))
+        if entry is None or entry[1] < nodes or (line is not None and entry[2] == line):
+            return None
+
+        board = pos.copy(stack=pos.halfmove_clock)  # only the moves that can lead to repetitions
+        if board.is_repetition(2):
+            return None
+        for move in entry[0]["pv"]:
+            if not board.is_legal(move):
+                break
+            board.push(move)
+            if board.is_repetition(2):
+                return None
+
+        info = dict(entry[0])
+        info["nodes"] = 0
+        return info
+
+    def store(self, pos: chess.Board, info: chess.engine.InfoDict, nodes: int, line=None):
+        """line: the line (e.g. root move) that searched pos"""
+        if "pv" not in info or "score" not in info:
+            return
+        key = chess.polyglot.zobrist_hash(pos)
+        entry = self.table.get(key)
+        if entry is None or entry[1] < nodes:
+            self.table[key] = (info, nodes, line)
+
+
+class PvNode:
+    """
+    A node in the trie of PVs of a search. The moves from the root of the trie to a node form a PV.
+    Positions are only cached at the root and at the ends of the PVs (the tips); the position of
+    another node is replayed from the nearest cached ancestor. A cached position only keeps
+    the moves since the last irreversible move, which is all that repetition detection needs.
+    Extending a PV only plays the new moves. Truncating it moves to an ancestor and drops the cut branch;
+    the first use of the new tip's position replays the kept moves from the root of the trie.
+    """
+    __slots__ = ("move", "parent", "children", "_pos", "length", "game_over")
+
+    def __init__(self, pos: chess.Board, move: chess.Move = None, parent=None, cache: bool = True):
+        self.move = move
+        self.parent = parent
+        self.children = {}  # key: move, value: PvNode
+        self._pos = pos if cache else None
+        self.length = parent.length + 1 if parent is not None else 0
+        self.game_over = pos.is_game_over()
+
+    @classmethod
+    def root(cls, pos: chess.Board):
+        return cls(pos.copy(stack=pos.halfmove_clock))
+
+    @property
+    def pos(self):
+        if self._pos is not None:
+            return self._pos
+        moves = []
+        node = self
+        while node._pos is None:
+            moves.append(node.move)
+            node = node.parent
+        pos = node._pos.copy(stack=node._pos.halfmove_clock)
+        for move in reversed(moves):
+            pos.push(move)
+        if not self.children:  # a tip
+            self._pos = pos.copy(stack=pos.halfmove_clock)
+        return pos
+
+    def child(self, move: chess.Move):
+        """Return the node after move, creating it if needed. The move must be legal."""
+        node = self.children.get(move)
+        if node is None:
+            pos = self.pos.copy(stack=self.pos.halfmove_clock)
+            pos.push(move)
+            node = PvNode(pos, move, self)
+            self.children[move] = node
+        return node
+
+    def extend(self, pv: list):
+        """Follow pv from this node, stopping at an illegal move or at the end of the game.
+        Return the last node reached, the new tip: the nodes on the way no longer cache their positions."""
+        node = self
+        pos = self.pos.copy(stack=self.pos.halfmove_clock)
+        for move in pv:
+            if move not in node.children.keys() and not pos.is_legal(move):
+                break
+            pos.push(move)
+            if move in node.children.keys():
+                next_node = node.children[move]
+            else:
+                next_node = PvNode(pos, move, node, cache=False)
+                node.children[move] = next_node
+            if node.parent is not None:
+                node._pos = None
+            node = next_node
+            if node.game_over:
+                break
+        if node is not self and node._pos is None and not node.children:
+            node._pos = pos.copy(stack=pos.halfmove_clock)
+        return node
+
+    def ancestor(self, length: int):
+        """Return the node on this node's PV with the given PV length."""
+        node = self
+        while node.length > length:
+            node = node.parent
+        return node
+
+    def truncate(self, length: int):
+        """Cut this node's PV to the given length. Returns the new tip, whose dead branches are dropped.
+        The new tip has no cached position yet: pos replays it once, from the nearest cached ancestor."""
+        node = self.ancestor(length)
+        node.children.clear()
+        return node
+
+    def pv(self):
+        """The moves from the root of the trie to this node."""
+        moves = []
+        node = self
+        while node.parent is not None:
+            moves.append(node.move)
+            node = node.parent
+        moves.reverse()
+        return moves
+
+
 def clamp(value, min_value, max_value):
     return max(min(value, max_value), min_value)
 
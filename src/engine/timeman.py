@@ -16,6 +16,7 @@ class Time:
     winc: int = 0
     btime: int = 0
     binc: int = 0
+    movestogo: int = 0  # moves until the next time control, 0 for sudden death
 
     time: [int, int] = [0, 0]  # black (0), white (1)
     inc: [int, int] = [0, 0]
@@ -23,11 +24,12 @@ class Time:
     us: chess.Color = None
     optTime = maxTime = 0
 
-    def __init__(self, wtime: int = 0, btime: int = 0, winc: int = 0, binc: int = 0):
+    def __init__(self, wtime: int = 0, btime: int = 0, winc: int = 0, binc: int = 0, movestogo: int = 0):
         self.wtime = wtime
         self.winc = winc
         self.btime = btime
         self.binc = binc
+        self.movestogo = movestogo
         self.time = [btime, wtime]
         self.inc = [binc, winc]
 
@@ -47,7 +49,13 @@ class Time:
 
         overhead = option("Move Overhead")
 
-        timeLeft = max(1, self.time[us] + self.inc[us] * 49 - overhead)
+        # With a repeating time control, the clock is shared out over the moves until the next control,
+        # otherwise we plan for 50 more moves
+        mtg = min(self.movestogo, 50) if self.movestogo > 0 else 50
+
+        # every move until the time control costs the overhead
+        totalOverhead = overhead * mtg if self.movestogo > 0 else overhead
+        timeLeft = max(1, self.time[us] + self.inc[us] * (mtg - 1) - totalOverhead)
 
         # Use extra time with larger increments
         # Also use less time with zero increment
@@ -62,21 +70,54 @@ class Time:
             advExtra = 1.0 + 0.2 * math.log10(timeRatio) + 0.1 * timeRatio - 1.0 * math.log10(incRatio)
             advExtra = utils.clamp(advExtra, 1.0, 3.0)
 
-        optScale = min((0.88 + ply / 116.4) / 50,
+        optScale = min((0.88 + ply / 116.4) / mtg,
                        0.88 * self.time[us] / timeLeft) * optExtra * advExtra
-        maxScale = min(3.0 + 0.05 * ply, 6.5)
+        maxScale = min(3.0 + 0.05 * ply, 6.5) if self.movestogo == 0 else min(1.5 + 0.11 * mtg, 6.3)
 
         # Never use more than x% of the available time for this move (scale based on ply)
         self.optTime = max(1, int(optScale * timeLeft))
-        maxTimePercent = min(0.70 + 0.001 * ply, 0.90)
+        maxTimePercent = min(0.70 + 0.001 * ply, 0.90) if mtg > 1 else 0.80
         self.maxTime = int(min(maxTimePercent * self.time[us] - overhead, maxScale * self.optTime))
         self.optTime = min(self.optTime, self.maxTime)  # optTime <= maxTime
 
     def to_Limit(self):
-        return self.wtime / 1000, self.btime / 1000, self.winc / 1000, self.binc / 1000
+        return self.wtime / 1000, self.btime / 1000, self.winc / 1000, self.binc / 1000, self.movestogo or None
 
     def useTimeMan(self):
         if self.us is None:
             return self.wtime > 0 or self.btime > 0
         else:
             return self.get_time(self.us) > 0 or self.optTime > 0 or self.maxTime > 0
+
+
+class Stability:
+    """
+    How stable the best move of a search is, so that time management can stop early in clear positions
+    and keep the time for critical ones.
+    """
+    MIN_STABLE_ITERS = 3  # never stop early before the best move has been the same for this many iterations
+
+    def __init__(self):
+        self.bestMove: chess.Move = None
+        self.stableIters = 0  # consecutive iterations with the same best move
+        self.scoreDelta = 0  # change of the best score in the last iteration (cp)
+        self.margin = 0  # how much better the best move is than the second best move (cp)
+
+    def update(self, bestMove: chess.Move, bestValue: int, prevBestValue: int, secondValue: int = None):
+        """Called after every iteration."""
+        if bestMove == self.bestMove:
+            self.stableIters += 1
+        else:
+            self.bestMove = bestMove
+            self.stableIters = 0
+        self.scoreDelta = abs(bestValue - prevBestValue)
+        self.margin = bestValue - secondValue if secondValue is not None else 0
+
+    def scale(self):
+        """The fraction of optTime that is worth using. Below 1.0 only if the best move is stable."""
+        if self.stableIters < self.MIN_STABLE_ITERS:
+            return 1.0
+        stableScale = max(1.0 - 0.06 * (self.stableIters - self.MIN_STABLE_ITERS + 1), 0.55)
+        scoreScale = utils.clamp(0.85 + self.scoreDelta / 133, 0.85, 1.0)  # a changing score needs more time
+        marginScale = utils.clamp(1.0 - self.margin / 400, 0.6, 1.0)
+        return max(stableScale * scoreScale * marginScale, 0.35)
@@ -12,18 +12,19 @@ import threading
 
 import chess.engine
 
+import evaluate
 import search
 from evaluate import engine
 from timeman import Time
 from utils import *
 from search_h import *
-from benchmark import bench
-
-# threads
-search_thread = None
+from benchmark import bench, bench_overhead
 
 pos = chess.Board()
 tm = Time()
+# what pos was set up from: 'startpos' or a FEN, and the moves played from it
+pos_base = "startpos"
+pos_moves = []
 
 
 def move_to_uci(move: chess.Move):
@@ -54,12 +55,44 @@ def fen_from_str(s: str):
     return [fen, moves]
 
 
+def set_position(command: str):
+    """
+    Handle a 'position' command.
+    GUIs usually resend the whole game before every move, so if the command only adds moves to
+    the current position, we play just the new moves instead of replaying the game.
+    """
+    global pos, pos_base, pos_moves
+    args = command.split(" ")[1:]
+    if args[:1] == ["startpos"]:
+        base = "startpos"
+    elif args[:1] == ["fen"]:
+        base = fen_from_str(" ".join(args[1:]))[0]
+    else:
+        return
+    moves = args[args.index("moves") + 1:] if "moves" in args else []
+
+    if base == pos_base and moves[:len(pos_moves)] == pos_moves:
+        # A search may still use the old position, so don't change it in place
+        pos = pos.copy()
+        new_moves = moves[len(pos_moves):]
+    else:
+        pos = chess.Board() if base == "startpos" else chess.Board(base)
+        pos_base, pos_moves = base, []
+        new_moves = moves
+
+    for move in new_moves:
+        move = uci_to_move(move)
+        if not pos.is_legal(move):
+            break
+        pos.push(move)
+        pos_moves.append(move.uci())
+
+
 def handle_command(command: str):
-    global search_thread, pos, tm
+    global tm
     command = preprocess(command)
     if command == "":
         return
-    search_thread = None
 
     tm = Time()  # initialize new timeman object
 
@@ -70,89 +103,52 @@ def handle_command(command: str):
         printf(options_str())
         printf("uciok")
     elif command == "isready":
+        # the engines are ready once they have started and applied all options
+        evaluate.ensure_engine()
         printf("readyok")
     elif command == "ucinewgame":
-        pos = chess.Board()
+        set_position("position startpos")
         tm = Time()
-    elif command == "position startpos":
-        pos = chess.Board()
-    elif command.startswith("position startpos moves"):
-        pos = chess.Board()
-        try:
-            moves = command.split(" ")[3:]
-        except IndexError:
-            moves = []
-        for move in moves:
-            move = uci_to_move(move)
-            if not pos.is_legal(move):
-                break
-            pos.push(move)
-    elif command.startswith("position fen") and "moves" in command:
-        # remove 'position fen '
-        s = ' '.join(command.split(" ")[2:])
-        obj = fen_from_str(s)
-        fen = obj[0]
-        moves = obj[1].split()
-        pos = chess.Board(fen)
-        for move in moves:
-            move = uci_to_move(move)
-            if not pos.is_legal(move):
-                break
-            pos.push(move)
-    elif command.startswith("position fen"):
-        s = ' '.join(command.split(" ")[2:])
-        fen = fen_from_str(s)[0]
-        pos = chess.Board(fen)
+        search.clear_search()
+    elif command.startswith("position"):
+        set_position(command)
     elif command.startswith("go"):
-        MAX_ITERS = GET_MAX_DEPTH()
+        limits = parse_go(command.split(" ")[1:])
 
+        MAX_ITERS = GET_MAX_DEPTH()
         if command.strip() == "go":
             MAX_ITERS = 10
+        if limits["depth"]:
+            MAX_ITERS = limits["depth"]
 
-        has_arg = command.split(" ").__len__() > 1
-        args = command.split(" ")
-        keyword = command.split(" ")[1] if has_arg else None
-
-        if has_arg and keyword == "movetime":
-            movetime = int(command.split(" ")[2])
-        else:
-            movetime = None
-
-        if has_arg and keyword == "nodes":
-            nodes = int(command.split(" ")[2])
-        else:
-            nodes = None
-
-        if has_arg and keyword == "depth":
-            MAX_ITERS = int(command.split(" ")[2])
-
-        if has_arg and keyword == "infinite":
-            MAX_ITERS = GET_MAX_DEPTH()
-
-        if has_arg and ("wtime" in args or "btime" in args):
-            wtime, btime, winc, binc = process_time(args)
-            tm.__init__(wtime, btime, winc, binc)
+        if limits["wtime"] is not None or limits["btime"] is not None:
+            tm.__init__(*[limits[name] or 0 for name in ["wtime", "btime", "winc", "binc", "movestogo"]])
 
         # start search
-        search_thread = threading.Thread(target=start_search, args=(pos, option("MAX_MOVES"), MAX_ITERS,
-                                                                    movetime, nodes, tm))
-        search_thread.start()
+        search.controller.go(rootPos=pos, MAX_MOVES=option("MAX_MOVES"), MAX_ITERS=MAX_ITERS,
+                             movetime=limits["movetime"], nodes=limits["nodes"], timeman=tm, ponder=limits["ponder"],
+                             searchmoves=limits["searchmoves"], mate=limits["mate"], infinite=limits["infinite"])
+
+    elif command == "ponderhit":
+        search.controller.ponderhit()
 
     # stop
     elif command == "stop":
-        search.stop_search()
-        if search_thread:
-            search_thread.join(timeout=0.5)
-            search_thread = None
+        # don't block the input thread for long, e.g. if the search is waiting for the engines to start
+        search.controller.stop(timeout=0.5)
 
     # quit
     elif command == "quit":
-        if search_thread:
-            search.stop_search()
-            search_thread.join(timeout=0.5)
+        search.controller.stop(timeout=1.0)
         os._exit(0)
 
     # bench
+    elif command.startswith("bench overhead"):
+        try:
+            calls = int(command.split(" ")[2])
+        except Exception:
+            calls = 1000
+        bench_overhead(calls)
     elif command.startswith("bench"):
         try:
             depth = int(command.split(" ")[1])
@@ -194,16 +190,15 @@ def handle_command(command: str):
 
 
 def handle_commands():
-    global search_thread, pos, tm
-    pos = chess.Board()
+    global tm
+    set_position("position startpos")
     tm = Time()
     if len(sys.argv) > 1:
         # split when there is a newline
         lst = ' '.join(sys.argv[1:]).split("\n")
         for command in lst:
             handle_command(command)
-        while search.IS_SEARCHING:
-            continue
+        search.controller.wait()
         os._exit(0)
 
     while True:
@@ -214,13 +209,6 @@ def handle_commands():
             continue
 
 
-def start_search(pos, MAX_MOVES, MAX_ITERS, time, nodes, tm):
-    while search.IS_SEARCHING:
-        continue
-
-    search.search(pos, MAX_MOVES=MAX_MOVES, MAX_ITERS=MAX_ITERS, movetime=time, nodes=nodes, timeman=tm)
-
-
 def uci():
     """
     Start the UCI interface.
@@ -228,6 +216,7 @@ def uci():
     global ENGINE_NAME
     ENGINE_NAME = engine_name_uci()
     printf(f"{ENGINE_NAME} by {ENGINE_AUTHOR}")
+    evaluate.warm_up()
 
     # Create a thread for handling UCI input
     uci_thread = threading.Thread(target=handle_commands)
@@ -235,29 +224,43 @@ def uci():
 
 
 # Helper functions
-def process_time(args: list):
-    wtime = btime = winc = binc = 0
-    try:
-        wtime = int(args[args.index("wtime") + 1])
-    except ValueError:
-        pass
-
-    try:
-        btime = int(args[args.index("btime") + 1])
-    except ValueError:
-        pass
-
-    try:
-        winc = int(args[args.index("winc") + 1])
-    except ValueError:
-        pass
-
-    try:
-        binc = int(args[args.index("binc") + 1])
-    except ValueError:
-        pass
-
-    return wtime, btime, winc, binc
+GO_INT_LIMITS = ["wtime", "btime", "winc", "binc", "movestogo", "depth", "nodes", "mate", "movetime"]
+GO_FLAGS = ["ponder", "infinite"]
+
+
+def parse_go(args: list):
+    """
+    Parse the arguments of a 'go' command. Any combination of limits can be given.
+    Returns a dict with an entry for every limit in GO_INT_LIMITS (None if not given),
+    every flag in GO_FLAGS, and 'searchmoves' (a list of chess.Move, or None).
+    """
+    limits = {name: None for name in GO_INT_LIMITS}
+    limits.update({name: False for name in GO_FLAGS})
+    limits["searchmoves"] = None
+
+    i = 0
+    while i < len(args):
+        token = args[i]
+        if token in GO_INT_LIMITS:
+            try:
+                limits[token] = int(args[i + 1])
+                i += 1
+            except (IndexError, ValueError):
+                pass
+        elif token in GO_FLAGS:
+            limits[token] = True
+        elif token == "searchmoves":
+            # all following moves, up to the next keyword
+            limits["searchmoves"] = []
+            while i + 1 < len(args) and args[i + 1] not in GO_INT_LIMITS + GO_FLAGS:
+                try:
+                    limits["searchmoves"].append(uci_to_move(args[i + 1]))
+                except ValueError:
+                    pass
+                i += 1
+        i += 1
+
+    return limits
 
 
 def preprocess(s: str):
@@ -23,13 +23,13 @@ class Option:
             self.func = func
 
         def set(self, value: str):
-            value = bool(value.lower())
+            value = value.lower() == "true"
             self.value = value
             if self.func:
                 self.func(value)
 
         def __str__(self):
-            return f"option name {self.name} type check default {self.default}"
+            return f"option name {self.name} type check default {str(self.default).lower()}"
 
     class Spin:
         """Numerical value."""
@@ -143,9 +143,53 @@ class Option:
 
 # Option specific functions
 def on_engine_param_change(unused):
-    """Called when the engine parameters are changed."""
-    from evaluate import setoptions_engine
-    setoptions_engine()
+    """Called when the engine parameters are changed. They are applied in the background."""
+    import evaluate
+    evaluate.in_background(evaluate.setoptions_engine)
+
+
+def on_pool_change(unused):
+    """Called when the number of workers or the backend is changed.
+    The pool is rebuilt once the running searches have finished: their jobs are in the pool."""
+    import evaluate
+    import search
+
+    def restart_pool():
+        search.wait_searches()
+        if evaluate.engine is not None or evaluate.async_pool is not None:
+            evaluate.init_engine_pool()
+            evaluate.setoptions_engine()
+
+    evaluate.in_background(restart_pool)
+
+
+def on_engine_path_change(unused):
+    """Called when the engine is changed: restart the engines if they are already running,
+    once the running searches have finished."""
+    import evaluate
+    import search
+
+    def restart_engine():
+        search.wait_searches()
+        if evaluate.engine is not None or evaluate.async_pool is not None:
+            evaluate.init_engine()
+
+    evaluate.in_background(restart_engine)
+
+
+def on_eval_cache_change(size_mb):
+    import evaluate
+    evaluate.eval_cache.resize(size_mb)
+
+
+def on_analysis_db_change(unused):
+    import evaluate
+    evaluate.open_analysis_db()
+
+
+def on_cost_model_change(unused):
+    import evaluate
+    evaluate.load_cost_model()
 
 
 def on_max_depth_change(unused):
@@ -183,24 +227,37 @@ def on_remove_engine_option(option_str):
 
 # UCI Options
 options = {
-    "ENGINE_PATH": Option.String("ENGINE_PATH", "stockfish"),
+    "ENGINE_PATH": Option.String("ENGINE_PATH", "stockfish", on_engine_path_change),
     "MAX_MOVES": Option.Spin("MAX_MOVES", 2, 1, 100),
     "Nodes": Option.SpinOrCombo("Nodes", "auto", 0, 1 << 32, ["auto"]),
     "Nodes scale": Option.Spin("Nodes scale", 500, 0, 1000),
     "MAX_DEPTH": Option.Spin("MAX_DEPTH", 256, 64, 1 << 16, on_max_depth_change),
     "MAX_HORIZON": Option.Spin("MAX_HORIZON", 30, 2, 1024, on_max_horizon_change),
     "debug": Option.Check("debug", False),
+    "Reuse tree": Option.Check("Reuse tree", True),  # continue from the previous search's PVs
+    # classic: search all root moves in every iteration
+    # bandit: only search the best move and its closest challengers in every iteration
+    "Scheduler": Option.Combo("Scheduler", "classic", ["classic", "bandit"]),
 
     # Default engine options
     "Threads": Option.Spin("Threads", 1, 1, 1024, func=on_engine_param_change),
     "Hash": Option.Spin("Hash", 256, 1, 1 << 25, func=on_engine_param_change),
     "MultiPV": Option.Spin("MultiPV", 1, 1, 500, func=None),
+    "Workers": Option.Spin("Workers", 1, 1, 256, func=on_pool_change),  # number of engine processes
+    "Backend": Option.Combo("Backend", "simple", ["simple", "async", "pipe"], func=on_pool_change),
+    # a warm standby engine that replaces an engine that crashes or hangs (simple and pipe backends)
+    "Spare engine": Option.Check("Spare engine", True, func=on_pool_change),
+    "Eval Cache": Option.Spin("Eval Cache", 16, 0, 1 << 16, func=on_eval_cache_change),  # in MB, 0 to disable
+    "Analysis DB": Option.String("Analysis DB", "", on_analysis_db_change),  # path to sqlite file, empty to disable
+    "Analysis DB size": Option.Spin("Analysis DB size", 1000000, 1000, 1 << 31, on_analysis_db_change),  # entries
+    "Cost model": Option.String("Cost model", "", on_cost_model_change),  # path to json file, empty to not save
 
     # Command to add/remove engine options
     "ADD_OPTION": Option.String("ADD_OPTION", "", on_add_engine_option),
     "REMOVE_OPTION": Option.String("REMOVE_OPTION", "", on_remove_engine_option),
 
     "Move Overhead": Option.Spin("Move Overhead", 100, 0, 5000),
+    "Ponder": Option.Check("Ponder", False),
 }
 
 
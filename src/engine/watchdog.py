@@ -0,0 +1,41 @@
+"""
+Watchdog for engine calls that hang.
+A single thread checks the deadlines of all calls in progress, so that watching a call costs
+no more than a dict update.
+"""
+import threading
+import time
+
+CHECK_INTERVAL = 0.1  # seconds between checks of the deadlines
+
+
+class Watchdog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deadlines = {}  # key: watched object, value: (deadline, function called when it is missed)
+        self.thread = None
+
+    def watch(self, key, seconds: float, on_timeout: callable):
+        """Call on_timeout() if unwatch(key) is not called within `seconds` seconds."""
+        with self.lock:
+            self.deadlines[key] = (time.time() + seconds, on_timeout)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def unwatch(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+    def run(self):
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            now = time.time()
+            with self.lock:
+                missed = [key for key, (deadline, _) in self.deadlines.items() if deadline < now]
+                callbacks = [self.deadlines.pop(key)[1] for key in missed]
+            for on_timeout in callbacks:
+                try:
+                    on_timeout()
+                except Exception:
+                    pass
@@ -8,13 +8,17 @@ import query_tb as query_tb
 
 def tracePV(startfen: str, MAX_MOVES=20, MAX_ITER=100, depth:int=None, nodes:int=None, time:int=None, mate:int=None,
             print_board=True, stop_on_tbhit=True, query_on_tbhit=True,
-            stop_on_draw=0, stop_on_eval=0):
+            stop_on_draw=0, stop_on_eval=0, new_game=False):
     """
     'Trace' the PV of a given FEN and keep calculating the next PV. This repeats until the end of the game
     or until the maximum number of iterations is reached.
+    The engine is kept running between traces; set new_game to clear its hash before this trace.
     """
     board = chess.Board(startfen)
     
+    if new_game:
+        engine.new_game()
+    
     if not depth:
         depth = None
     if not nodes:
@@ -136,11 +140,15 @@ def main():
         query_on_tbhit = bool(config["QUERY_ON_TBHIT"])
         stop_on_draw = int(config["STOP_ON_DRAW"])
         stop_on_eval = int(config["STOP_ON_EVAL"])
+        new_game = bool(config["NEW_GAME"])
         
         
     tracePV(startfen, depth=depth, nodes=nodes, time=time, mate=mate, MAX_MOVES=max_moves, MAX_ITER=max_iter,
             print_board=print_board, stop_on_tbhit=stop_on_tbhit, query_on_tbhit=query_on_tbhit,
-            stop_on_draw=stop_on_draw, stop_on_eval=stop_on_eval)
+            stop_on_draw=stop_on_draw, stop_on_eval=stop_on_eval, new_game=new_game)
+    engine.close_engine()
+    if engine.analysis_db is not None:
+        engine.analysis_db.close()
     utils.write_pgn()
     
     
@@ -1,11 +1,59 @@
 import chess, chess.engine
+import os, sys
 import yaml
 import utils.utils as utils
 
+# the analysis database is shared with PVengine
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "engine"))
+from analysis_db import AnalysisDB
+
 with open("src/config.yml", "r") as f:
     config = yaml.safe_load(f)
     ENGINE_PATH = config["ENGINE_PATH"]
     engine_options = config["ENGINE_OPTIONS"]
+    ANALYSIS_DB = config["ANALYSIS_DB"]
+    ANALYSIS_DB_SIZE = int(config["ANALYSIS_DB_SIZE"])
+
+analysis_db = AnalysisDB(ANALYSIS_DB, ANALYSIS_DB_SIZE) if ANALYSIS_DB else None
+
+engine: chess.engine.SimpleEngine = None
+game = object()  # python-chess sends ucinewgame whenever this object changes
+
+
+def open_engine():
+    """Start the engine if it is not running yet, and return it.
+    The same engine is reused across iterations and traces, so it keeps its hash."""
+    global engine
+    if engine is None:
+        engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
+        
+        # Set options
+        for name, value in engine_options.items():
+            engine.configure({name: value})
+    return engine
+
+
+def close_engine():
+    global engine
+    if engine is not None:
+        try:
+            engine.quit()
+        except chess.engine.EngineTerminatedError:
+            pass
+        engine = None
+
+
+def restart_engine():
+    """Quit the engine and start a fresh process."""
+    close_engine()
+    return open_engine()
+
+
+def new_game():
+    """Send ucinewgame (clearing the hash) before the next search."""
+    global game
+    game = object()
+
 
 def __engine__(fen: str=None, depth: int=None, nodes: int=None, time: int=None, mate: int=None):
     """
@@ -14,12 +62,8 @@ def __engine__(fen: str=None, depth: int=None, nodes: int=None, time: int=None,
     nodes: number of nodes to search
     time: time to search for
     """
-    # 1. Create a new engine
-    engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
-    
-    # Set options
-    for name, value in engine_options.items():
-        engine.configure({name: value})
+    # 1. Get the engine
+    open_engine()
     
     # 2. Create board
     board = chess.Board(fen)
@@ -30,13 +74,26 @@ def __engine__(fen: str=None, depth: int=None, nodes: int=None, time: int=None,
     # 4. Evaluate with engine
     # We prefer to pass the entire moves list to the engine, so that it is not
     # blind to threefold repetition.
-    if fen:
-        result = engine.analyse(board, limit)
-    else:  # we use ROOT_BOARD in order to preserve move stack
-        result = engine.analyse(utils.ROOT_BOARD, limit)
+    if not fen:  # we use ROOT_BOARD in order to preserve move stack
+        board = utils.ROOT_BOARD
+    
+    # Use the analysis database if this position was already searched deep enough
+    use_db = analysis_db is not None and not time and not mate
+    engine_id = engine.id.get("name", ENGINE_PATH)
+    if use_db:
+        result = analysis_db.probe(board, engine_id, depth=depth, nodes=nodes)
+        if result is not None:
+            return result
+    
+    try:
+        result = engine.analyse(board, limit, game=game)
+    except chess.engine.EngineTerminatedError:
+        # the engine crashed, start a new one and try again
+        restart_engine()
+        result = engine.analyse(board, limit, game=game)
     
-    # 5. Close the engine
-    engine.quit()
+    if use_db:
+        analysis_db.store(board, result, engine_id, nodes or 0)
     
-    # 6. Return the info
-    return result
\ No newline at end of file
+    # 5. Return the info
+    return result